@@ -0,0 +1,82 @@
+"""Micro-benchmark for RatingButton.handle_vote with 10, 1k and 10k existing voters.
+
+Runs offline against a throwaway data folder:
+
+    python benchmarks/bench_handle_vote.py [json|sqlite]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VOTER_COUNTS = (10, 1_000, 10_000)
+VOTES_PER_RUN = 2_000
+
+
+class FakeResponse:
+    async def defer(self):
+        pass
+
+
+class FakeGuild:
+    id = 1
+
+    def get_member(self, user_id):
+        return None
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+
+
+class FakeMessage:
+    id = 1
+    guild = FakeGuild()
+    embeds = []
+
+    async def edit(self, **kwargs):
+        pass
+
+
+class FakeInteraction:
+    def __init__(self, user_id):
+        self.user = FakeUser(user_id)
+        self.guild = FakeGuild()
+        self.message = FakeMessage()
+        self.response = FakeResponse()
+
+
+async def bench(main, voters: int):
+    message_id = 10_000_000 + voters
+    for user_id in range(voters):
+        main.storage.set_rating(message_id, user_id, user_id % 5 + 1)
+
+    button = main.RatingButton(1, message_id, 5)
+    start = time.perf_counter()
+    for i in range(VOTES_PER_RUN):
+        # Alternate between vote changes by existing voters and brand-new voters
+        user_id = i % voters if i % 2 else voters + i
+        await button.handle_vote(FakeInteraction(user_id), i % 5 + 1)
+    elapsed = time.perf_counter() - start
+    print(f"{voters:>6} voters: {elapsed / VOTES_PER_RUN * 1e6:8.1f} µs/vote")
+
+
+async def run():
+    os.environ["STORAGE_BACKEND"] = sys.argv[1] if len(sys.argv) > 1 else "json"
+    sys.path.insert(0, ROOT)
+    os.chdir(tempfile.mkdtemp(prefix="bench_votes_"))
+    import main
+    main.storage.load()
+    print(f"handle_vote ({os.environ['STORAGE_BACKEND']} backend)")
+    for voters in VOTER_COUNTS:
+        await bench(main, voters)
+    # The trailing embed refresh reads storage, so let it finish before closing it
+    await asyncio.gather(*list(main.rating_refresher._tasks.values()))
+    main.storage.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
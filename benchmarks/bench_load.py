@@ -0,0 +1,441 @@
+"""Offline load test: replays synthetic traffic through the real handlers in main.py.
+
+Discord objects are in-process fakes (each API call just sleeps --api-latency) and the
+chatbot talks to a fake Groq server on localhost, so nothing leaves the machine:
+
+    python benchmarks/bench_load.py [chat|votes|raid ...] [--output results.json] [--compare old.json]
+
+Profiles:
+    chat   chat-heavy channel: small talk, AFK mentions/returns, bot mentions (Groq)
+    votes  vote storm on a few rated edits (RatingButton.handle_vote)
+    raid   join wave + spam, answered with warn, afk and clear
+
+Per profile it reports events/sec, p50/p99 handler latency per event kind and RSS, and
+writes everything to --output for comparison with a later run (--compare).
+"""
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SNOWFLAKE = 1_100_000_000_000_000_000
+GROQ_PORT = 18769
+
+
+# ----- Fake Discord -----
+_ids = itertools.count(SNOWFLAKE)
+API_LATENCY = 0.02  # seconds per fake Discord API call (set from --api-latency)
+
+
+async def api_call():
+    await asyncio.sleep(API_LATENCY)
+
+
+class FakePermissions:
+    def __getattr__(self, name):
+        return True  # staff everywhere: the benchmark is about handler cost, not permission checks
+
+
+class FakeRole:
+    def __init__(self, position):
+        self.position = position
+
+    def __ge__(self, other):
+        return self.position >= other.position
+
+
+class FakeMember:
+    def __init__(self, guild, name, bot=False, joined_ago=timedelta(days=365)):
+        self.id = next(_ids)
+        self.guild = guild
+        self.name = name
+        self.display_name = name
+        self.nick = None
+        self.bot = bot
+        self.mention = f"<@{self.id}>"
+        self.joined_at = main.discord.utils.utcnow() - joined_ago
+        self.top_role = FakeRole(10 if bot else 1)
+        self.guild_permissions = main.discord.Permissions.all() if bot else main.discord.Permissions.none()
+
+    async def edit(self, nick=None, **kwargs):
+        await api_call()
+        self.nick = nick
+        self.display_name = nick or self.name
+
+    async def timeout(self, duration, reason=None):
+        await api_call()
+
+
+class FakeGuild:
+    def __init__(self):
+        self.id = next(_ids)
+        self.name = "Bench Guild"
+        self.shard_id = 0
+        self.channels = []
+        self.members = []
+        self._members = {}
+        self.me = self.add_member("Area 69", bot=True)
+        self.owner_id = self.me.id
+
+    def add_member(self, name, **kwargs) -> FakeMember:
+        member = FakeMember(self, name, **kwargs)
+        self.members.append(member)
+        self._members[member.id] = member
+        return member
+
+    def get_member(self, user_id):
+        return self._members.get(user_id)
+
+
+class FakeMessage:
+    def __init__(self, channel, author, content="", mentions=(), attachments=(), created_at=None):
+        self.id = next(_ids)
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.clean_content = content
+        self.mentions = list(mentions)
+        self.mention_everyone = False
+        self.attachments = list(attachments)
+        self.embeds = []
+        self.created_at = created_at or main.discord.utils.utcnow()
+
+    async def reply(self, content=None, embed=None, view=None):
+        return await self.channel.send(content=content, embed=embed)
+
+    async def edit(self, content=None, embed=None, **kwargs):
+        await api_call()
+        if embed is not None:
+            self.embeds = [embed]
+
+    async def delete(self):
+        await api_call()
+
+
+class FakeChannel:
+    def __init__(self, guild):
+        self.id = next(_ids)
+        self.guild = guild
+        self.name = "general"
+        self.history_messages = []  # newest first
+        guild.channels.append(self)
+
+    async def send(self, content=None, embed=None, **kwargs):
+        await api_call()
+        message = FakeMessage(self, self.guild.me, content or "")
+        if embed is not None:
+            message.embeds = [embed]
+        return message
+
+    @contextlib.asynccontextmanager
+    async def typing(self):
+        yield
+
+    def permissions_for(self, member):
+        return FakePermissions()
+
+    async def history(self, limit=100, before=None):
+        for message in self.history_messages[:limit]:
+            yield message
+
+    async def delete_messages(self, messages):
+        await api_call()
+        gone = {m.id for m in messages}
+        self.history_messages = [m for m in self.history_messages if m.id not in gone]
+
+
+class FakeContext:
+    def __init__(self, channel, author, command):
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.message = FakeMessage(channel, author, f"69 {command.name}")
+        self.command = command
+
+    async def send(self, content=None, embed=None, **kwargs):
+        return await self.channel.send(content=content, embed=embed)
+
+
+class FakeResponse:
+    async def defer(self):
+        pass
+
+
+class FakeInteraction:
+    def __init__(self, user, message):
+        self.user = user
+        self.guild = message.guild
+        self.message = message
+        self.response = FakeResponse()
+
+
+class FakeBotUser:
+    def __init__(self, member):
+        self.id = member.id
+        self.name = member.name
+
+    def mentioned_in(self, message):
+        return any(user.id == self.id for user in message.mentions)
+
+
+# ----- Fake Groq -----
+groq_stats = {"requests": 0, "in_flight": 0, "max_in_flight": 0}
+
+
+async def start_fake_groq(latency: float, words: int):
+    """OpenAI-style /chat/completions that answers after `latency` seconds (streamed or not)."""
+    from aiohttp import web
+
+    async def completions(request):
+        groq_stats["requests"] += 1
+        groq_stats["in_flight"] += 1
+        groq_stats["max_in_flight"] = max(groq_stats["max_in_flight"], groq_stats["in_flight"])
+        try:
+            return await answer(request)
+        finally:
+            groq_stats["in_flight"] -= 1
+
+    async def answer(request):
+        body = await request.json()
+        tokens = [f"word{i} " for i in range(words)]
+        usage = {"prompt_tokens": sum(len(m["content"]) // 4 for m in body["messages"]),
+                 "completion_tokens": words, "total_tokens": 0}
+        if not body.get("stream"):
+            await asyncio.sleep(latency)
+            return web.json_response({
+                "id": "bench", "object": "chat.completion", "created": 0, "model": body["model"],
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": "".join(tokens)}}],
+                "usage": usage})
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for i, token in enumerate(tokens):
+            await asyncio.sleep(latency / words)
+            chunk = {"id": "bench", "object": "chat.completion.chunk", "created": 0, "model": body["model"],
+                     "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}
+            if i == words - 1:
+                chunk["x_groq"] = {"id": "bench", "usage": usage}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    app = web.Application()
+    app.router.add_post("/openai/v1/chat/completions", completions)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", GROQ_PORT).start()
+    return runner
+
+
+# ----- Profiles -----
+# A profile yields (kind, coroutine function) events; they run with bounded concurrency,
+# like discord.py dispatching gateway events into separate tasks.
+def chat_profile(guild, channel, events: int):
+    members = [guild.add_member(f"chatter{i}") for i in range(200)]
+    bot_member = guild.me
+    afk_members = members[:10]
+    for member in afk_members:
+        main.storage.set_afk(member.id, "brb", member.name)
+    for i in range(events):
+        author = random.choice(members)
+        roll = random.random()
+        if roll < 0.15:
+            message = FakeMessage(channel, author, f"@{bot_member.name} tell me a joke {i}", [bot_member])
+            yield "on_message:chat", lambda m=message: main.on_message(m)
+        elif roll < 0.30:
+            target = random.choice(afk_members)
+            message = FakeMessage(channel, author, f"hey @{target.name}", [target])
+            yield "on_message:afk_mention", lambda m=message: main.on_message(m)
+        else:
+            message = FakeMessage(channel, author, f"just chatting {i}")
+            yield "on_message:plain", lambda m=message: main.on_message(m)
+
+
+def votes_profile(guild, channel, events: int):
+    editor = guild.add_member("editor")
+    voters = [guild.add_member(f"voter{i}") for i in range(2_000)]
+    rated = []
+    for _ in range(5):
+        edit = FakeMessage(channel, editor, "new edit https://streamable.com/abc")
+        rating_message = FakeMessage(channel, guild.me)
+        rating_message.embeds = [main.make_rating_embed(editor.display_name, edit.id)]
+        rated.append((edit, rating_message))
+    for i in range(events):
+        edit, rating_message = random.choice(rated)
+        rating = random.randint(1, 5)
+        button = main.RatingButton(editor.id, edit.id, rating)
+        interaction = FakeInteraction(random.choice(voters), rating_message)
+        yield "handle_vote", lambda b=button, it=interaction, r=rating: b.handle_vote(it, r)
+
+
+def raid_profile(guild, channel, events: int):
+    moderator = guild.add_member("moderator")
+    regulars = [guild.add_member(f"regular{i}") for i in range(50)]
+    raiders = []
+    for i in range(events):
+        roll = random.random()
+        if roll < 0.25 or not raiders:
+            raider = guild.add_member(f"raider{i}", joined_ago=timedelta(seconds=i))
+            raiders.append(raider)
+            yield "on_member_join", lambda m=raider: main.on_member_join(m)
+        elif roll < 0.80:
+            message = FakeMessage(channel, random.choice(raiders), f"FREE NITRO discord.gift/{i}")
+            channel.history_messages.insert(0, message)
+            yield "on_message:spam", lambda m=message: main.on_message(m)
+        elif roll < 0.90:
+            ctx = FakeContext(channel, moderator, main.warn)
+            target = random.choice(raiders)
+            yield "warn", lambda c=ctx, t=target: main.warn.callback(c, t, reason="raid spam")
+        elif roll < 0.95:
+            ctx = FakeContext(channel, random.choice(regulars), main.afk)
+            yield "afk", lambda c=ctx: main.afk.callback(c, reason="raid, brb")
+        else:
+            ctx = FakeContext(channel, moderator, main.clear)
+            yield "clear", lambda c=ctx: main.clear.callback(c, 50, "contains:nitro")
+
+
+PROFILES = {"chat": chat_profile, "votes": votes_profile, "raid": raid_profile}
+
+
+# ----- Runner -----
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+async def run_profile(name: str, events: int, concurrency: int) -> dict:
+    guild = FakeGuild()
+    channel = FakeChannel(guild)
+    main.bot._connection.user = FakeBotUser(guild.me)
+    latencies = {}
+    errors = 0
+    slots = asyncio.Semaphore(concurrency)
+
+    async def run_event(kind, handler):
+        nonlocal errors
+        async with slots:
+            start = time.perf_counter()
+            try:
+                await handler()
+            except Exception as e:
+                errors += 1
+                if errors <= 3:
+                    print(f"  {kind} failed: {e!r}")
+            latencies.setdefault(kind, []).append(time.perf_counter() - start)
+
+    workload = list(PROFILES[name](guild, channel, events))
+    start = time.perf_counter()
+    await asyncio.gather(*(run_event(kind, handler) for kind, handler in workload))
+    elapsed = time.perf_counter() - start
+    await asyncio.sleep(main.RATING_REFRESH_WINDOW + 0.5)  # let trailing rating edits finish
+
+    result = {
+        "events": len(workload),
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "events_per_sec": round(len(workload) / elapsed, 1),
+        "rss_mb": round(main.process_rss_mb(), 1),
+        "latency_ms": {},
+    }
+    for kind, values in sorted(latencies.items()):
+        values.sort()
+        result["latency_ms"][kind] = {"count": len(values),
+                                      "p50": round(percentile(values, 0.50) * 1000, 2),
+                                      "p99": round(percentile(values, 0.99) * 1000, 2)}
+    return result
+
+
+def print_result(name: str, result: dict, baseline: dict = None):
+    def delta(new, old, higher_is_better):
+        if not old:
+            return ""
+        change = (new - old) / old * 100
+        regressed = change < -10 if higher_is_better else change > 10
+        return f" ({change:+.0f}%{' !' if regressed else ''})"
+
+    base = (baseline or {}).get(name, {})
+    print(f"\n{name}: {result['events']} events in {result['seconds']}s, "
+          f"{result['events_per_sec']} events/s{delta(result['events_per_sec'], base.get('events_per_sec'), True)}, "
+          f"RSS {result['rss_mb']} MiB, {result['errors']} errors")
+    for kind, stats in result["latency_ms"].items():
+        old = base.get("latency_ms", {}).get(kind, {})
+        print(f"  {kind:<24} n={stats['count']:<6} p50 {stats['p50']:8.2f} ms{delta(stats['p50'], old.get('p50'), False)}"
+              f"   p99 {stats['p99']:8.2f} ms{delta(stats['p99'], old.get('p99'), False)}")
+
+
+async def run(args):
+    global main, API_LATENCY
+    API_LATENCY = args.api_latency
+    os.environ.setdefault("GROQ_API_KEY", "bench")
+    os.environ["GROQ_BASE_URL"] = f"http://127.0.0.1:{GROQ_PORT}"
+    os.environ["STORAGE_BACKEND"] = args.storage
+    os.environ["HEALTH_PORT"] = "0"
+    if args.no_rate_limit:
+        for scope in ("USER", "CHANNEL", "GUILD"):
+            os.environ[f"RATE_LIMIT_{scope}"] = "1000000000/1"
+    sys.path.insert(0, ROOT)
+    os.chdir(tempfile.mkdtemp(prefix="bench_load_"))
+    import main
+    main.storage.load()
+    random.seed(args.seed)
+    groq_server = await start_fake_groq(args.groq_latency, args.groq_words)
+    await main.http_client.start()
+
+    results = {"meta": {"storage": args.storage, "events": args.events, "concurrency": args.concurrency,
+                        "api_latency": args.api_latency, "groq_latency": args.groq_latency,
+                        "rate_limited": not args.no_rate_limit,
+                        "python": sys.version.split()[0], "time": time.strftime("%Y-%m-%d %H:%M:%S")}}
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    try:
+        for name in args.profiles:
+            results[name] = await run_profile(name, args.events, args.concurrency)
+            print_result(name, results[name], baseline)
+    finally:
+        await main.http_client.close()
+        await groq_server.cleanup()
+        main.storage.close()
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nSaved results to {args.output}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("profiles", nargs="*", help=f"any of {', '.join(PROFILES)} (default: all)")
+    parser.add_argument("--events", type=int, default=2_000, help="events per profile")
+    parser.add_argument("--concurrency", type=int, default=50, help="events handled at once")
+    parser.add_argument("--storage", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--api-latency", type=float, default=0.02, help="seconds per fake Discord API call")
+    parser.add_argument("--groq-latency", type=float, default=0.3, help="seconds per fake Groq completion")
+    parser.add_argument("--groq-words", type=int, default=30, help="words per fake Groq completion")
+    parser.add_argument("--no-rate-limit", action="store_true",
+                        help="lift the chat rate limits to measure raw Groq throughput")
+    parser.add_argument("--seed", type=int, default=69)
+    parser.add_argument("--output", default="bench_load_results.json")
+    parser.add_argument("--compare", help="earlier --output file to diff against")
+    args = parser.parse_args()
+    args.profiles = args.profiles or list(PROFILES)
+    unknown = set(args.profiles) - set(PROFILES)
+    if unknown:
+        parser.error(f"unknown profile(s): {', '.join(sorted(unknown))}")
+    args.output = os.path.abspath(args.output)
+    args.compare = args.compare and os.path.abspath(args.compare)
+    return args
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
@@ -0,0 +1,101 @@
+"""RSS of 1M warnings / 1M rating votes: legacy dict layout vs the slotted/array records.
+
+Each case is built in a fresh subprocess so the numbers don't share an allocator:
+
+    python benchmarks/bench_memory.py
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RECORDS = 1_000_000
+SNOWFLAKE = 1_100_000_000_000_000_000  # realistic 19-digit IDs (not small-int cached)
+REASONS = [f"spam {i}" for i in range(100)]
+
+
+def rss_mb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+
+
+def warnings_legacy(main):
+    # {str(guild_id): {str(user_id): [{"moderator", "reason", "timestamp": iso}]}}
+    data = {}
+    now = time.time()
+    for i in range(RECORDS):
+        guild = data.setdefault(str(SNOWFLAKE + i % 1_000), {})
+        guild.setdefault(str(SNOWFLAKE + i // 10), []).append({
+            "moderator": SNOWFLAKE + i % 50, "reason": REASONS[i % 100],
+            "timestamp": main.datetime.fromtimestamp(now - i, main.TIMEZONE).isoformat()})
+    return data
+
+
+def warnings_records(main):
+    # {guild_id: {user_id: [WarningRecord]}} with epoch-int timestamps
+    data = {}
+    now = int(time.time())
+    for i in range(RECORDS):
+        guild = data.setdefault(SNOWFLAKE + i % 1_000, {})
+        guild.setdefault(SNOWFLAKE + i // 10, []).append(
+            main.WarningRecord(SNOWFLAKE + i % 50, REASONS[i % 100], now - i))
+    return data
+
+
+def ratings_legacy(main):
+    # {message_id: {user_id: rating}}, 10k messages x 100 voters
+    data = {}
+    for i in range(RECORDS):
+        data.setdefault(SNOWFLAKE + i // 100, {})[SNOWFLAKE + i] = i % 5 + 1
+    return data
+
+
+def ratings_columns(main):
+    # {message_id: RatingColumn}
+    data = {}
+    for i in range(RECORDS):
+        votes = data.get(SNOWFLAKE + i // 100)
+        if votes is None:
+            votes = data[SNOWFLAKE + i // 100] = main.RatingColumn()
+        votes.set(SNOWFLAKE + i, i % 5 + 1)
+    return data
+
+
+CASES = {
+    "warnings: dicts + ISO strings": warnings_legacy,
+    "warnings: WarningRecord": warnings_records,
+    "ratings: nested dicts": ratings_legacy,
+    "ratings: RatingColumn": ratings_columns,
+}
+
+
+def run_case(name):
+    sys.path.insert(0, ROOT)
+    os.chdir(tempfile.mkdtemp(prefix="bench_memory_"))
+    import main
+    before = rss_mb()
+    start = time.perf_counter()
+    data = CASES[name](main)
+    elapsed = time.perf_counter() - start
+    print(json.dumps({"rss_mb": rss_mb() - before, "build_s": elapsed}))
+    del data
+
+
+def run():
+    print(f"{RECORDS:,} records per case")
+    for name in CASES:
+        out = subprocess.run([sys.executable, __file__, name], capture_output=True, text=True, check=True).stdout
+        result = json.loads(out.strip().splitlines()[-1])
+        print(f"{name:<32} {result['rss_mb']:8.1f} MiB  ({result['build_s']:.1f}s to build)")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        run_case(sys.argv[1])
+    else:
+        run()
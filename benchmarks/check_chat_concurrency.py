@@ -0,0 +1,113 @@
+"""Offline check: 20 chat completions in flight don't stall the rest of the bot.
+
+Fires 20 concurrent generate_chat_response calls (half streamed) at the fake Groq server
+from bench_load.py and, while they run, keeps invoking a cheap command and sampling
+event-loop lag. Fails (non-zero exit) unless:
+
+  * command latency and loop lag stay low while the completions are in flight,
+  * the fake server never sees more than CHAT_MAX_INFLIGHT requests at once,
+  * requests that can't get a slot within CHAT_QUEUE_TIMEOUT get CHAT_BUSY_REPLY.
+
+    python benchmarks/check_chat_concurrency.py
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_load import GROQ_PORT, groq_stats, start_fake_groq  # noqa: E402
+
+REQUESTS = 20
+GUILDS = 4
+GROQ_LATENCY = 0.5       # seconds per fake completion
+MAX_INFLIGHT = 8
+MAX_INFLIGHT_PER_GUILD = 3
+QUEUE_TIMEOUT = 0.8      # so the later requests in each guild are turned away
+MAX_COMMAND_MS = 50      # generous: a command that doesn't touch Groq should take ~0 ms
+MAX_LOOP_LAG_MS = 50
+
+
+class FakeContext:
+    async def send(self, content=None, embed=None, **kwargs):
+        pass
+
+
+async def probe_commands(main, stop: asyncio.Event) -> list:
+    """Run a real command every 20 ms until stopped; return latencies in ms."""
+    ctx, latencies = FakeContext(), []
+    while not stop.is_set():
+        start = time.perf_counter()
+        await main.joke.callback(ctx)
+        latencies.append((time.perf_counter() - start) * 1000)
+        await asyncio.sleep(0.02)
+    return latencies
+
+
+async def probe_loop_lag(stop: asyncio.Event) -> list:
+    """How late 10 ms sleeps wake up, in ms."""
+    lags = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.01)
+        lags.append((time.perf_counter() - start - 0.01) * 1000)
+    return lags
+
+
+async def run():
+    os.environ["GROQ_API_KEY"] = "check"
+    os.environ["GROQ_BASE_URL"] = f"http://127.0.0.1:{GROQ_PORT}"
+    os.environ["CHAT_MAX_INFLIGHT"] = str(MAX_INFLIGHT)
+    os.environ["CHAT_MAX_INFLIGHT_PER_GUILD"] = str(MAX_INFLIGHT_PER_GUILD)
+    os.environ["CHAT_QUEUE_TIMEOUT"] = str(QUEUE_TIMEOUT)
+    os.environ["HEALTH_PORT"] = "0"
+    sys.path.insert(0, ROOT)
+    os.chdir(tempfile.mkdtemp(prefix="check_chat_"))
+    import main
+    main.storage.load()
+    groq_server = await start_fake_groq(GROQ_LATENCY, words=20)
+
+    async def on_delta(text):
+        pass
+
+    # The first completion pays one-off client setup (lazy imports, connection pool); keep it out of the numbers
+    await main.generate_chat_response("warm up", user_id=1, guild_id=-1)
+    groq_stats.update(requests=0, max_in_flight=0)
+    stop = asyncio.Event()
+    probes = [asyncio.create_task(probe_commands(main, stop)), asyncio.create_task(probe_loop_lag(stop))]
+    try:
+        start = time.perf_counter()
+        replies = await asyncio.gather(*(
+            main.generate_chat_response(f"hello {i}", user_id=1000 + i, guild_id=i % GUILDS,
+                                        on_delta=on_delta if i % 2 else None)
+            for i in range(REQUESTS)))
+        elapsed = time.perf_counter() - start
+    finally:
+        stop.set()
+        command_ms, lag_ms = await asyncio.gather(*probes)
+        await main.groq_client.close()
+        await groq_server.cleanup()
+        main.storage.close()
+
+    busy = sum(reply == main.CHAT_BUSY_REPLY for reply in replies)
+    answered = sum(reply.startswith("word0") for reply in replies)
+    print(f"{REQUESTS} requests in {elapsed:.2f}s: {answered} answered, {busy} busy; "
+          f"fake Groq saw {groq_stats['requests']} requests, max {groq_stats['max_in_flight']} at once")
+    print(f"command latency while in flight: n={len(command_ms)} max {max(command_ms):.2f} ms; "
+          f"loop lag max {max(lag_ms):.2f} ms")
+
+    assert answered + busy == REQUESTS, f"unexpected replies: {[r for r in replies if r != main.CHAT_BUSY_REPLY][:3]}"
+    assert groq_stats["max_in_flight"] <= MAX_INFLIGHT, "global completion cap exceeded"
+    assert answered >= MAX_INFLIGHT, "fewer completions ran than the caps allow"
+    assert busy > 0, "queued requests were never turned away with CHAT_BUSY_REPLY"
+    assert elapsed < QUEUE_TIMEOUT + 2 * GROQ_LATENCY + 0.5, "requests waited past CHAT_QUEUE_TIMEOUT"
+    assert len(command_ms) >= 10, "the command probe barely ran"
+    assert max(command_ms) < MAX_COMMAND_MS, "commands stalled while completions were in flight"
+    assert max(lag_ms) < MAX_LOOP_LAG_MS, "event loop stalled while completions were in flight"
+    print("OK")
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
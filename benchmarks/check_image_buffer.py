@@ -0,0 +1,105 @@
+"""Offline check for ImageBuffer and the shared HTTP client against a local aiohttp server.
+
+Fails (non-zero exit) unless:
+
+  * get() on a filled buffer answers without any HTTP request,
+  * the buffer is topped up again in the background after get(),
+  * a provider slower than HTTP_TIMEOUT makes get() fail after ~HTTP_TIMEOUT, and a
+    background refill against it gives up instead of hanging.
+
+    python benchmarks/check_image_buffer.py
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PORT = 18770
+HTTP_TIMEOUT = 0.5
+SLOW_DELAY = 5.0      # the slow endpoint answers long after HTTP_TIMEOUT
+
+
+async def start_provider(hits: dict):
+    """/images returns a fresh batch of IMAGE_BUFFER_SIZE URLs; /slow takes SLOW_DELAY seconds."""
+    from aiohttp import web
+
+    async def images(request):
+        hits["images"] += 1
+        await asyncio.sleep(0.05)
+        return web.json_response([{"url": f"http://img.local/{hits['images']}/{i}"}
+                                  for i in range(int(request.query["limit"]))])
+
+    async def slow(request):
+        hits["slow"] += 1
+        await asyncio.sleep(SLOW_DELAY)
+        return web.json_response([])
+
+    app = web.Application()
+    app.router.add_get("/images", images)
+    app.router.add_get("/slow", slow)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT).start()
+    return runner
+
+
+async def run():
+    os.environ["HTTP_TIMEOUT"] = str(HTTP_TIMEOUT)
+    os.environ["HEALTH_PORT"] = "0"
+    sys.path.insert(0, ROOT)
+    os.chdir(tempfile.mkdtemp(prefix="check_images_"))
+    import main
+    assert main.HTTP_TIMEOUT == HTTP_TIMEOUT
+
+    hits = {"images": 0, "slow": 0}
+    provider = await start_provider(hits)
+    extract = lambda data: [image["url"] for image in data]  # noqa: E731
+    size = main.IMAGE_BUFFER_SIZE
+    try:
+        buffer = main.ImageBuffer(f"http://127.0.0.1:{PORT}/images?limit={size}", extract)
+        buffer.refill()
+        await buffer._refill_task
+        assert hits["images"] == 1 and len(buffer.urls) == size, (hits, len(buffer.urls))
+
+        # Served from the buffer: no request while get() runs
+        start = time.perf_counter()
+        url = await buffer.get()
+        served_ms = (time.perf_counter() - start) * 1000
+        assert url == "http://img.local/1/0", url
+        assert hits["images"] == 1, "buffered get() made a request"
+        assert len(buffer.urls) == size - 1
+
+        # ...and topped up in the background afterwards
+        await buffer._refill_task
+        assert hits["images"] == 2 and len(buffer.urls) == size, (hits, len(buffer.urls))
+        print(f"buffered get() in {served_ms:.2f} ms with no request; refilled in the background")
+
+        # HTTP_TIMEOUT bounds both the foreground fetch and the background refill
+        slow = main.ImageBuffer(f"http://127.0.0.1:{PORT}/slow", extract)
+        start = time.perf_counter()
+        try:
+            await slow.get()
+        except asyncio.TimeoutError:
+            pass
+        else:
+            raise AssertionError("get() against a slow provider didn't time out")
+        waited = time.perf_counter() - start
+        assert waited < HTTP_TIMEOUT + 0.5, f"get() waited {waited:.2f}s, HTTP_TIMEOUT is {HTTP_TIMEOUT}s"
+
+        slow.refill()
+        start = time.perf_counter()
+        await asyncio.wait_for(slow._refill_task, SLOW_DELAY)
+        refill_waited = time.perf_counter() - start
+        assert refill_waited < HTTP_TIMEOUT + 0.5 and not slow.urls
+        print(f"slow provider: get() timed out after {waited:.2f}s, refill gave up after {refill_waited:.2f}s "
+              f"(HTTP_TIMEOUT {HTTP_TIMEOUT}s)")
+    finally:
+        await main.http_client.close()
+        await provider.cleanup()
+    print("OK")
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -3,27 +3,84 @@ import discord
 from discord.ext import commands, tasks
 from dotenv import load_dotenv
 import asyncio
+import collections
+import contextlib
 from datetime import datetime, timedelta
 import pytz
 from typing import Optional, Union
 import random
-from flask import Flask
-from threading import Thread
-import requests
 import time
 import json
+import logging
+import re
+import heapq
+import bisect
+import array
+import sqlite3
+import subprocess
+import signal
+import sys
 import aiohttp
+from aiohttp import web
 import groq
 
 # ========= Load environment =========
 load_dotenv()
 
 # ========= Intents / Bot =========
-intents = discord.Intents.default()
+# Only the gateway events the bot handles: guild/channel state, member joins (raid tools,
+# AFK nicknames), guild + DM messages and their content. No presences, typing, voice,
+# reactions, invites etc.
+intents = discord.Intents.none()
+intents.guilds = True
 intents.members = True
+intents.guild_messages = True
+intents.dm_messages = True
 intents.message_content = True
 
-bot = commands.Bot(command_prefix='69 ', intents=intents, case_insensitive=True)
+def parse_shard_ids(value: str) -> list:
+    """"0-3" / "0,2,5" / "0-1,4" -> [0, 1, 2, 3] etc. Raises ValueError."""
+    ids = []
+    for part in filter(None, (p.strip() for p in value.split(","))):
+        start, _, end = part.partition("-")
+        ids.extend(range(int(start), int(end or start) + 1))
+    return sorted(set(ids))
+
+# Sharding: SHARDING=auto lets Discord pick the shard count; SHARD_IDS (+ SHARD_COUNT) runs
+# only that shard range in this process so several processes can split the bot.
+SHARD_IDS = parse_shard_ids(os.getenv("SHARD_IDS", "")) or None
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0")) or None
+SHARDED = bool(SHARD_IDS or SHARD_COUNT or os.getenv("SHARDING", "").lower() == "auto")
+if SHARD_IDS and not SHARD_COUNT:
+    raise SystemExit("SHARD_IDS needs SHARD_COUNT (the total number of shards)")
+
+# Member cache: "full" chunks every guild at startup; "minimal" caches no members up front
+# and relies on RecentMembers (joiners, chatters) plus fetch_member for the rest.
+MEMBER_CACHE = os.getenv("MEMBER_CACHE", "full").lower()
+MINIMAL_MEMBER_CACHE = MEMBER_CACHE == "minimal"
+
+class Area69Bot(commands.AutoShardedBot if SHARDED else commands.Bot):
+    async def setup_hook(self):
+        await http_client.start()
+        for buffer in image_buffers.values():
+            buffer.refill()
+        await health_server.start()
+        # docker stop / systemd send SIGTERM, which Client.run doesn't handle; shut down cleanly instead
+        with contextlib.suppress(NotImplementedError):  # no signal handlers on Windows event loops
+            self.loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(self.close()))
+
+    async def close(self):
+        await health_server.stop()
+        await http_client.close()
+        await super().close()
+        await storage.flush()  # don't leave the last FLUSH_INTERVAL of writes to the post-run close()
+
+bot_options = {}
+if SHARDED:
+    bot_options.update(shard_ids=SHARD_IDS, shard_count=SHARD_COUNT)
+if MINIMAL_MEMBER_CACHE:
+    bot_options.update(member_cache_flags=discord.MemberCacheFlags.none(), chunk_guilds_at_startup=False)
+bot = Area69Bot(command_prefix='69 ', intents=intents, case_insensitive=True, **bot_options)
 bot.remove_command('help')  # Remove default help command
 
 # ========= Constants =========
@@ -31,71 +88,946 @@ TIMEZONE = pytz.timezone('Asia/Kathmandu')
 AFK_PREFIX = '[AFK]'
 MAX_WARNINGS = 3
 WARNING_TIMEOUT = timedelta(hours=1)
+WARNING_EXPIRY = timedelta(0)  # warnings older than this stop counting (per-guild setting; default 0 = never)
 DELETE_DELAY = 30  # moderation/afk/help messages auto-delete after 30s
+AFK_NOTICE_WINDOW = float(os.getenv('AFK_NOTICE_WINDOW', 120))  # seconds between notices about one AFK user per channel
 
-# ========= Data storage (JSON persistence) =========
+# ========= Metrics =========
+METRICS_ENABLED = os.getenv("METRICS", "0").lower() in ("1", "true", "yes", "on")
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # seconds
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", r"\\").replace('"', r'\"').replace("\n", r"\n")
+
+class Metrics:
+    """Counters and latency histograms in Prometheus text format.
+
+    Every call returns immediately while disabled, so instrumentation can stay in the
+    hot paths. Label values must be low-cardinality (command names, route templates).
+    """
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.counters = {}    # {(name, labels): value}
+        self.histograms = {}  # {(name, labels): [bucket counts..., +Inf count, sum]}
+        self.help = {}        # {name: (type, help text)}
+        self.collectors = []  # functions returning [(name, type, value)], read at scrape time
+
+    def describe(self, name: str, kind: str, text: str):
+        self.help[name] = (kind, text)
+
+    def collect(self, func):
+        """Register a function whose samples are read on every render (for stats kept elsewhere)."""
+        self.collectors.append(func)
+        return func
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name: str, seconds: float, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = [0] * (len(METRICS_BUCKETS) + 1) + [0.0]
+        hist[bisect.bisect_left(METRICS_BUCKETS, seconds)] += 1
+        hist[-1] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def summary(self, name: str) -> list:
+        """[(labels dict, count, mean seconds, ~p99 seconds)] for one histogram, busiest first."""
+        rows = []
+        for (hist_name, labels), hist in self.histograms.items():
+            if hist_name != name:
+                continue
+            count = sum(hist[:-1])
+            if not count:
+                continue
+            # p99 as the upper bound of the bucket holding the 99th percentile
+            target, seen, p99 = count * 0.99, 0, float("inf")
+            for bound, bucket in zip(METRICS_BUCKETS, hist):
+                seen += bucket
+                if seen >= target:
+                    p99 = bound
+                    break
+            rows.append((dict(labels), count, hist[-1] / count, p99))
+        return sorted(rows, key=lambda row: row[1], reverse=True)
+
+    def counter(self, name: str, **labels) -> float:
+        """Sum of a counter over every label set matching `labels`."""
+        wanted = set(labels.items())
+        return sum(value for (counter_name, key), value in self.counters.items()
+                   if counter_name == name and wanted <= set(key))
+
+    @staticmethod
+    def _labels(labels, extra=()) -> str:
+        pairs = [*labels, *extra]
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{_escape_label(v)}"' for k, v in pairs) + "}"
+
+    def render(self) -> str:
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                help_kind, text = self.help.get(name, (kind, ""))
+                if text:
+                    lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {help_kind}")
+
+        for (name, labels), value in sorted(self.counters.items()):
+            header(name, "counter")
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), hist in sorted(self.histograms.items()):
+            header(name, "histogram")
+            cumulative = 0
+            for bound, bucket in zip((*METRICS_BUCKETS, "+Inf"), hist):
+                cumulative += bucket
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {hist[-1]}")
+            lines.append(f"{name}_count{self._labels(labels)} {cumulative}")
+        for collector in self.collectors:
+            for name, kind, value in collector():
+                header(name, kind)
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics(METRICS_ENABLED)
+metrics.describe("area69_loop_lag_seconds", "histogram", "How late the event loop ran a timed sleep")
+metrics.describe("area69_command_seconds", "histogram", "Prefix command run time")
+metrics.describe("area69_command_errors_total", "counter", "Prefix commands that raised")
+metrics.describe("area69_message_stage_seconds", "histogram", "on_message pipeline stage run time")
+metrics.describe("area69_discord_api_seconds", "histogram", "Discord REST call latency (rate-limit waits included)")
+metrics.describe("area69_discord_api_errors_total", "counter", "Discord REST calls that failed, by status")
+metrics.describe("area69_discord_rate_limited_total", "counter", "429 responses / rate-limit waits logged by discord.py")
+metrics.describe("area69_storage_flush_seconds", "histogram", "Storage write-behind flush time")
+metrics.describe("area69_chat_seconds", "histogram", "Groq chat completion time")
+metrics.describe("area69_chat_first_token_seconds", "histogram", "Time to the first streamed Groq delta")
+metrics.describe("area69_chat_tokens_total", "counter", "Groq tokens used")
+metrics.describe("area69_chat_errors_total", "counter", "Failed Groq chat completions")
+metrics.describe("area69_rate_limited_total", "counter", "Commands / chat mentions refused by the rate limiter")
+
+class RateLimitLogHandler(logging.Handler):
+    """Counts discord.py's rate-limit log lines (it retries 429s itself, so callers never see them)."""
+
+    def emit(self, record):
+        message = record.getMessage()
+        if "responded with 429" in message:
+            metrics.inc("area69_discord_rate_limited_total", kind="429")
+        elif message.startswith("Global rate limit"):
+            metrics.inc("area69_discord_rate_limited_total", kind="global")
+
+def instrument_discord_http(http):
+    """Time every REST call made through discord.py's HTTPClient.request."""
+    request = http.request
+
+    async def timed_request(route, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await request(route, **kwargs)
+        except discord.HTTPException as e:
+            metrics.inc("area69_discord_api_errors_total", route=route.path, status=e.status)
+            raise
+        finally:
+            metrics.observe("area69_discord_api_seconds", time.perf_counter() - start,
+                            method=route.method, route=route.path)
+
+    http.request = timed_request
+
+if METRICS_ENABLED:
+    instrument_discord_http(bot.http)
+    logging.getLogger("discord.http").addHandler(RateLimitLogHandler(logging.WARNING))
+
+    @bot.before_invoke
+    async def start_command_timer(ctx):
+        ctx.metrics_start = time.perf_counter()
+
+    @bot.after_invoke
+    async def stop_command_timer(ctx):
+        if hasattr(ctx, "metrics_start"):
+            metrics.observe("area69_command_seconds", time.perf_counter() - ctx.metrics_start,
+                            command=ctx.command.qualified_name)
+
+# ========= Data storage =========
 DATA_FOLDER = "data"
-AFK_FILE = os.path.join(DATA_FOLDER, "afk_users.json")            # keys: user_id(str) -> {reason, original_nick}
+AFK_FILE = os.path.join(DATA_FOLDER, "afk_users.json")            # keys: user_id(str) -> {reason, original_nick, since, mentions, guild_id}
 WARNINGS_FILE = os.path.join(DATA_FOLDER, "user_warnings.json")    # keys: guild_id(str) -> user_id(str) -> [warnings]
-MOD_LOG_FILE = os.path.join(DATA_FOLDER, "mod_log_channels.json")  # keys: guild_id(str) -> channel_id(int)
+MOD_LOG_FILE = os.path.join(DATA_FOLDER, "mod_log_channels.json")  # legacy; migrated into guild_settings.json
+GUILD_SETTINGS_FILE = os.path.join(DATA_FOLDER, "guild_settings.json")  # keys: guild_id(str) -> {setting: value}
 RATINGS_FILE = os.path.join(DATA_FOLDER, "ratings.json")           # keys: message_id(int) -> {user_id(int): rating(int)}
 CONFIG_FILE = os.path.join(DATA_FOLDER, "config.json")             # config data
+DELETIONS_FILE = os.path.join(DATA_FOLDER, "pending_deletions.json")  # keys: "channel_id:message_id" -> deadline(epoch)
+SQLITE_FILE = os.path.join(DATA_FOLDER, "bot.db")
+# SQLite calls run on the event loop, so a write waiting on another cluster worker's lock blocks
+# it; WAL writes take well under a millisecond, so a short wait is plenty.
+SQLITE_BUSY_TIMEOUT = float(os.getenv("SQLITE_BUSY_TIMEOUT", 0.25))  # seconds
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").lower()  # "json" or "sqlite"
+FLUSH_INTERVAL = 5  # seconds between write-behind flushes of dirty datasets
+RATING_RECENT_VOTERS = 10  # voters listed on a rating embed (most recent first)
+RATING_REFRESH_WINDOW = float(os.getenv('RATING_REFRESH_WINDOW', 2))  # min seconds between edits of one rating message
+
+# Cluster mode: the launcher (CLUSTER_WORKERS=N) starts N shard workers that share SQLITE_FILE;
+# each worker gets CLUSTER_WORKER=<index> and sees the others' writes through the changes table.
+CLUSTER_WORKERS = int(os.getenv("CLUSTER_WORKERS", "1"))
+CLUSTER_WORKER = int(os.environ["CLUSTER_WORKER"]) if "CLUSTER_WORKER" in os.environ else None
+CLUSTER_SYNC_INTERVAL = float(os.getenv("CLUSTER_SYNC_INTERVAL", 1))  # seconds between polls of the changes table
+CLUSTER_CHANGES_RETENTION = 600  # seconds a change row is kept for workers to pick up
 
 os.makedirs(DATA_FOLDER, exist_ok=True)
 
-afk_users = {}        # {str(user_id): {"reason": str, "original_nick": str}}
-user_warnings = {}    # {str(guild_id): {str(user_id): [{"moderator": id, "reason": str, "timestamp": iso}]}}
-mod_log_channels = {} # {str(guild_id): int(channel_id)}
-edit_ratings = {}     # {int(message_id): {int(user_id): int(rating)}}
-config = {}           # config data
-EDIT_CHANNEL_ID = None  # Channel ID for edit ratings
-
-def load_data():
-    global afk_users, user_warnings, mod_log_channels, edit_ratings, config, EDIT_CHANNEL_ID
-    try:
-        with open(AFK_FILE, "r", encoding="utf-8") as f:
-            afk_users = json.load(f)
-    except:
-        afk_users = {}
-    try:
-        with open(WARNINGS_FILE, "r", encoding="utf-8") as f:
-            user_warnings = json.load(f)
-    except:
-        user_warnings = {}
-    try:
-        with open(MOD_LOG_FILE, "r", encoding="utf-8") as f:
-            mod_log_channels = json.load(f)
-    except:
-        mod_log_channels = {}
-    try:
-        with open(RATINGS_FILE, "r", encoding="utf-8") as f:
-            # Convert keys back to int
-            edit_ratings = {int(k): {int(u): v for u, v in vdict.items()} for k, vdict in json.load(f).items()}
-    except:
-        edit_ratings = {}
+def _read_json(path: str, default):
     try:
-        with open(CONFIG_FILE, "r", encoding="utf-8") as f:
-            config = json.load(f)
-            EDIT_CHANNEL_ID = config.get("edit_channel_id", None)
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
     except:
-        config = {}
-        EDIT_CHANNEL_ID = None
-
-def save_data():
-    with open(AFK_FILE, "w", encoding="utf-8") as f:
-        json.dump(afk_users, f, indent=4)
-    with open(WARNINGS_FILE, "w", encoding="utf-8") as f:
-        json.dump(user_warnings, f, indent=4)
-    with open(MOD_LOG_FILE, "w", encoding="utf-8") as f:
-        json.dump(mod_log_channels, f, indent=4)
-    with open(RATINGS_FILE, "w", encoding="utf-8") as f:
-        json.dump(edit_ratings, f, indent=4)
-    with open(CONFIG_FILE, "w", encoding="utf-8") as f:
-        json.dump(config, f, indent=4)
-
-@tasks.loop(minutes=5)
-async def save_data_task():
-    save_data()
+        return default
+
+def _write_json_atomic(path: str, data):
+    """Write to a temp file and rename over the target so a crash never leaves half a file."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def _epoch(timestamp) -> int:
+    """Epoch seconds from an int or a legacy ISO string ("" -> 0)."""
+    if isinstance(timestamp, str):
+        return int(datetime.fromisoformat(timestamp).timestamp()) if timestamp else 0
+    return int(timestamp)
+
+
+# Records handed out by the storage backends. IDs are int snowflakes, times are epoch seconds.
+class AfkEntry:
+    __slots__ = ("reason", "original_nick", "since", "mentions", "guild_id")
+
+    def __init__(self, reason: str, original_nick: Optional[str], since: int = 0, mentions: int = 0,
+                 guild_id: Optional[int] = None):
+        self.reason = reason
+        self.original_nick = original_nick
+        self.since = since        # when they went AFK (0 for entries from older versions)
+        self.mentions = mentions  # times they were pinged while AFK
+        self.guild_id = guild_id  # guild whose nickname got the AFK prefix (None for older entries)
+
+    def to_dict(self) -> dict:
+        return {"reason": self.reason, "original_nick": self.original_nick, "since": self.since,
+                "mentions": self.mentions, "guild_id": self.guild_id}
+
+
+class WarningRecord:
+    __slots__ = ("moderator_id", "reason", "timestamp")
+
+    def __init__(self, moderator_id: Optional[int], reason: Optional[str], timestamp: int):
+        self.moderator_id = moderator_id
+        self.reason = reason
+        self.timestamp = timestamp
+
+    def to_dict(self) -> dict:
+        return {"moderator": self.moderator_id, "reason": self.reason, "timestamp": self.timestamp}
+
+
+class RatingColumn:
+    """One message's votes: user IDs sorted in a uint64 array with uint8 scores alongside.
+
+    ~9 bytes per vote instead of a dict entry plus two int objects; lookups bisect the
+    ID array. `recent` keeps the last RATING_RECENT_VOTERS voters, newest last.
+    """
+
+    __slots__ = ("user_ids", "scores", "recent")
+
+    def __init__(self):
+        self.user_ids = array.array("Q")
+        self.scores = array.array("B")
+        self.recent = []
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def set(self, user_id: int, rating: int) -> Optional[int]:
+        """Record a vote and return the user's previous rating (None if new)."""
+        i = bisect.bisect_left(self.user_ids, user_id)
+        if i < len(self.user_ids) and self.user_ids[i] == user_id:
+            previous = self.scores[i]
+            self.scores[i] = rating
+        else:
+            previous = None
+            self.user_ids.insert(i, user_id)
+            self.scores.insert(i, rating)
+        if user_id in self.recent:
+            self.recent.remove(user_id)
+        self.recent.append(user_id)
+        del self.recent[:-RATING_RECENT_VOTERS]
+        return previous
+
+    def get(self, user_id: int) -> Optional[int]:
+        i = bisect.bisect_left(self.user_ids, user_id)
+        return self.scores[i] if i < len(self.user_ids) and self.user_ids[i] == user_id else None
+
+    def items(self):
+        """(user_id, rating) pairs with the recent voters last, in vote order."""
+        recent = set(self.recent)
+        for user_id, rating in zip(self.user_ids, self.scores):
+            if user_id not in recent:
+                yield user_id, rating
+        for user_id in self.recent:
+            yield user_id, self.get(user_id)
+
+    def pack(self) -> tuple:
+        """Raw copy of the column: two buffer copies, cheap enough to take on the event loop."""
+        return bytes(self.user_ids), bytes(self.scores), tuple(self.recent)
+
+    @staticmethod
+    def unpack_votes(packed: tuple) -> dict:
+        """{user_id: rating} in items() order from a pack() copy (run off the event loop)."""
+        user_ids, scores = array.array("Q"), array.array("B")
+        user_ids.frombytes(packed[0])
+        scores.frombytes(packed[1])
+        recent = packed[2]
+        if not recent:
+            return dict(zip(user_ids, scores))
+        recent_set = set(recent)
+        votes = {u: r for u, r in zip(user_ids, scores) if u not in recent_set}
+        for user_id in recent:
+            votes[user_id] = scores[bisect.bisect_left(user_ids, user_id)]
+        return votes
+
+
+def _first_warning_since(records: list, since: int) -> int:
+    """Index of the first record at/after `since` in a timestamp-sorted list."""
+    lo, hi = 0, len(records)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if records[mid].timestamp < since:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+class Storage:
+    """Interface shared by the storage backends. All IDs are ints at this boundary."""
+
+    def load(self):
+        pass
+
+    async def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    # AFK
+    def get_afk(self, user_id: int) -> Optional[AfkEntry]:
+        raise NotImplementedError
+
+    def set_afk(self, user_id: int, reason: str, original_nick: str, guild_id: Optional[int] = None):
+        raise NotImplementedError
+
+    def pop_afk(self, user_id: int) -> Optional[AfkEntry]:
+        raise NotImplementedError
+
+    def get_all_afk(self) -> list:
+        """Return (user_id, AfkEntry) for everyone who is AFK."""
+        raise NotImplementedError
+
+    def is_afk(self, user_id: int) -> bool:
+        """O(1) in-memory check, cheap enough for every message."""
+        raise NotImplementedError
+
+    def record_afk_mentions(self, user_ids: list):
+        """Count one mention for each of these AFK users."""
+        raise NotImplementedError
+
+    # Warnings
+    # Warnings are kept in timestamp order per member, so "since" queries never scan history.
+    def add_warning(self, guild_id: int, user_id: int, moderator_id: int, reason: str, timestamp: int):
+        raise NotImplementedError
+
+    def get_warnings(self, guild_id: int, user_id: int, since: Optional[datetime] = None) -> list:
+        """Return the member's WarningRecords, oldest first."""
+        raise NotImplementedError
+
+    def count_warnings(self, guild_id: int, user_id: int, since: Optional[datetime] = None) -> int:
+        raise NotImplementedError
+
+    def clear_warnings(self, guild_id: int, user_id: int) -> int:
+        """Remove all of a member's warnings and return how many there were."""
+        raise NotImplementedError
+
+    def purge_warnings_before(self, guild_id: int, before: datetime) -> int:
+        """Drop a guild's warnings older than `before` and return how many were removed."""
+        raise NotImplementedError
+
+    # Ratings
+    def set_rating(self, message_id: int, user_id: int, rating: int):
+        raise NotImplementedError
+
+    def get_ratings(self, message_id: int) -> dict:
+        raise NotImplementedError
+
+    def get_rating_summary(self, message_id: int) -> dict:
+        """Return {'count', 'total', 'histogram': [1★..5★ counts], 'recent': [(user_id, rating)]}
+        without walking every vote."""
+        raise NotImplementedError
+
+    # Per-guild settings / config
+    def load_guild_settings(self, guild_id: int) -> Optional[dict]:
+        raise NotImplementedError
+
+    def save_guild_settings(self, guild_id: int, settings: dict):
+        raise NotImplementedError
+
+    def get_config(self, key: str, default=None):
+        raise NotImplementedError
+
+    def set_config(self, key: str, value):
+        raise NotImplementedError
+
+    # Scheduled auto-deletions
+    def add_pending_deletion(self, channel_id: int, message_id: int, deadline: float):
+        raise NotImplementedError
+
+    def remove_pending_deletions(self, keys: list):
+        """Forget deletions that were carried out; keys are (channel_id, message_id) tuples."""
+        raise NotImplementedError
+
+    def get_pending_deletions(self) -> list:
+        """Return (deadline, channel_id, message_id) tuples."""
+        raise NotImplementedError
+
+    # Cross-process invalidation (cluster mode)
+    def poll_changes(self) -> list:
+        """Return (topic, key) changes made by other processes since the last poll."""
+        return []
+
+
+class JsonStorage(Storage):
+    """Everything in memory, written behind to the JSON files in data/."""
+
+    def __init__(self):
+        self.afk_users = {}        # {user_id: AfkEntry}
+        self.user_warnings = {}    # {guild_id: {user_id: [WarningRecord]}}, oldest first
+        self.guild_settings = {}   # {guild_id: {setting: value}}
+        self.edit_ratings = {}     # {message_id: RatingColumn}
+        self.rating_stats = {}     # {message_id: [count, total, h1, h2, h3, h4, h5]}
+        self.config = {}           # config data
+        self.pending_deletions = {} # {(channel_id, message_id): deadline}
+        # dataset name -> (file, snapshot function, optional build function). Snapshots are cheap
+        # on-loop copies so the worker thread can serialize them while handlers keep mutating the
+        # live data; build, if set, turns a snapshot into JSON data on the worker thread.
+        self.datasets = {
+            "afk": (AFK_FILE, lambda: {str(u): entry.to_dict() for u, entry in self.afk_users.items()}, None),
+            "warnings": (WARNINGS_FILE, lambda: {str(g): {str(u): [w.to_dict() for w in ws] for u, ws in users.items()}
+                                                 for g, users in self.user_warnings.items()}, None),
+            "guild_settings": (GUILD_SETTINGS_FILE, lambda: {str(g): s for g, s in self.guild_settings.items()}, None),
+            "ratings": (RATINGS_FILE, lambda: {m: votes.pack() for m, votes in self.edit_ratings.items()},
+                        lambda packed: {m: RatingColumn.unpack_votes(p) for m, p in packed.items()}),
+            "config": (CONFIG_FILE, lambda: dict(self.config), None),
+            "deletions": (DELETIONS_FILE, lambda: {f"{c}:{m}": deadline
+                                                   for (c, m), deadline in self.pending_deletions.items()}, None),
+        }
+        self._dirty = set()  # names of datasets changed since the last flush
+
+    def load(self):
+        self.afk_users = {int(u): AfkEntry(d.get('reason', 'AFK'), d.get('original_nick'), d.get('since', 0),
+                                           d.get('mentions', 0), d.get('guild_id'))
+                          for u, d in _read_json(AFK_FILE, {}).items()}
+        self.user_warnings = {}
+        for gid, users in _read_json(WARNINGS_FILE, {}).items():
+            self.user_warnings[int(gid)] = {
+                int(uid): sorted((WarningRecord(w.get('moderator'), w.get('reason'), _epoch(w.get('timestamp', 0)))
+                                  for w in ws), key=lambda w: w.timestamp)
+                for uid, ws in users.items()}
+        guild_settings = _read_json(GUILD_SETTINGS_FILE, None)
+        if guild_settings is None:  # first start with per-guild settings: carry over mod log channels
+            guild_settings = {gid: {"mod_log_channel": cid} for gid, cid in _read_json(MOD_LOG_FILE, {}).items()}
+        self.guild_settings = {int(g): settings for g, settings in guild_settings.items()}
+        self.edit_ratings, self.rating_stats = {}, {}
+        for message_id, votes in _read_json(RATINGS_FILE, {}).items():
+            for user_id, rating in votes.items():  # file order is vote order
+                self.set_rating(int(message_id), int(user_id), int(rating))
+        self.config = _read_json(CONFIG_FILE, {})
+        self.pending_deletions = {tuple(map(int, key.split(":"))): deadline
+                                  for key, deadline in _read_json(DELETIONS_FILE, {}).items()}
+        self._dirty.clear()
+
+    def mark_dirty(self, *names: str):
+        """Queue datasets for the next background flush instead of writing them now."""
+        self._dirty.update(names)
+
+    @staticmethod
+    def _write_snapshots(snapshots):
+        for path, data, build in snapshots:
+            _write_json_atomic(path, build(data) if build else data)
+
+    async def flush(self):
+        """Write every dirty dataset from a worker thread."""
+        if not self._dirty:
+            return
+        names = list(self._dirty)
+        self._dirty.clear()
+        snapshots = [(path, snapshot(), build) for path, snapshot, build in map(self.datasets.get, names)]
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write_snapshots, snapshots)
+        except Exception as e:
+            self._dirty.update(names)  # retry on the next tick
+            print(f"Error flushing data ({', '.join(names)}): {e}")
+
+    def close(self):
+        """Synchronously write every dataset (shutdown only)."""
+        self._dirty.clear()
+        self._write_snapshots([(path, snapshot(), build) for path, snapshot, build in self.datasets.values()])
+
+    def get_afk(self, user_id):
+        return self.afk_users.get(user_id)
+
+    def set_afk(self, user_id, reason, original_nick, guild_id=None):
+        self.afk_users[user_id] = AfkEntry(reason, original_nick, int(time.time()), 0, guild_id)
+        self.mark_dirty("afk")
+
+    def pop_afk(self, user_id):
+        entry = self.afk_users.pop(user_id, None)
+        if entry is not None:
+            self.mark_dirty("afk")
+        return entry
+
+    def get_all_afk(self):
+        return list(self.afk_users.items())
+
+    def is_afk(self, user_id):
+        return user_id in self.afk_users
+
+    def record_afk_mentions(self, user_ids):
+        for user_id in user_ids:
+            self.afk_users[user_id].mentions += 1
+        self.mark_dirty("afk")
+
+    def add_warning(self, guild_id, user_id, moderator_id, reason, timestamp):
+        records = self.user_warnings.setdefault(guild_id, {}).setdefault(user_id, [])
+        record = WarningRecord(moderator_id, reason, timestamp)
+        if records and records[-1].timestamp > timestamp:
+            records.insert(_first_warning_since(records, timestamp + 1), record)
+        else:
+            records.append(record)
+        self.mark_dirty("warnings")
+
+    def get_warnings(self, guild_id, user_id, since=None):
+        records = self.user_warnings.get(guild_id, {}).get(user_id, [])
+        return records[_first_warning_since(records, since.timestamp()) if since else 0:]
+
+    def count_warnings(self, guild_id, user_id, since=None):
+        records = self.user_warnings.get(guild_id, {}).get(user_id, [])
+        return len(records) - (_first_warning_since(records, since.timestamp()) if since else 0)
+
+    def clear_warnings(self, guild_id, user_id):
+        removed = self.user_warnings.get(guild_id, {}).pop(user_id, [])
+        if removed:
+            self.mark_dirty("warnings")
+        return len(removed)
+
+    def purge_warnings_before(self, guild_id, before):
+        users = self.user_warnings.get(guild_id, {})
+        cutoff = before.timestamp()
+        removed = 0
+        for user_id in list(users):
+            expired = _first_warning_since(users[user_id], cutoff)
+            if expired:
+                del users[user_id][:expired]
+                removed += expired
+                if not users[user_id]:
+                    del users[user_id]
+        if removed:
+            self.mark_dirty("warnings")
+        return removed
+
+    def set_rating(self, message_id, user_id, rating):
+        votes = self.edit_ratings.get(message_id)
+        if votes is None:
+            votes = self.edit_ratings[message_id] = RatingColumn()
+        stats = self.rating_stats.setdefault(message_id, [0, 0, 0, 0, 0, 0, 0])
+        previous = votes.set(user_id, rating)
+        if previous is None:
+            stats[0] += 1
+        else:
+            stats[1] -= previous
+            stats[previous + 1] -= 1
+        stats[1] += rating
+        stats[rating + 1] += 1
+        self.mark_dirty("ratings")
+
+    def get_ratings(self, message_id):
+        votes = self.edit_ratings.get(message_id)
+        return dict(votes.items()) if votes is not None else {}
+
+    def get_rating_summary(self, message_id):
+        stats = self.rating_stats.get(message_id, [0, 0, 0, 0, 0, 0, 0])
+        votes = self.edit_ratings.get(message_id)
+        recent = [(user_id, votes.get(user_id)) for user_id in reversed(votes.recent)] if votes is not None else []
+        return {'count': stats[0], 'total': stats[1], 'histogram': stats[2:], 'recent': recent}
+
+    def load_guild_settings(self, guild_id):
+        settings = self.guild_settings.get(guild_id)
+        return dict(settings) if settings is not None else None
+
+    def save_guild_settings(self, guild_id, settings):
+        self.guild_settings[guild_id] = settings
+        self.mark_dirty("guild_settings")
+
+    def get_config(self, key, default=None):
+        return self.config.get(key, default)
+
+    def set_config(self, key, value):
+        self.config[key] = value
+        self.mark_dirty("config")
+
+    def add_pending_deletion(self, channel_id, message_id, deadline):
+        self.pending_deletions[(channel_id, message_id)] = deadline
+        self.mark_dirty("deletions")
+
+    def remove_pending_deletions(self, keys):
+        for key in keys:
+            self.pending_deletions.pop(tuple(key), None)
+        self.mark_dirty("deletions")
+
+    def get_pending_deletions(self):
+        return [(deadline, channel_id, message_id) for (channel_id, message_id), deadline in self.pending_deletions.items()]
+
+
+class SqliteStorage(Storage):
+    """Indexed tables in an SQLite file (WAL mode); every mutation is a single-row write."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS afk (
+            user_id INTEGER PRIMARY KEY,
+            reason TEXT NOT NULL,
+            original_nick TEXT,
+            since INTEGER NOT NULL DEFAULT 0,
+            mentions INTEGER NOT NULL DEFAULT 0,
+            guild_id INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS warnings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            moderator_id INTEGER,
+            reason TEXT,
+            timestamp INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_warnings_member ON warnings (guild_id, user_id, timestamp);
+        CREATE INDEX IF NOT EXISTS idx_warnings_guild_time ON warnings (guild_id, timestamp);
+        CREATE TABLE IF NOT EXISTS ratings (
+            message_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            rating INTEGER NOT NULL,
+            updated_at REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (message_id, user_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_ratings_recent ON ratings (message_id, updated_at);
+        CREATE TABLE IF NOT EXISTS rating_stats (
+            message_id INTEGER PRIMARY KEY,
+            count INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            h1 INTEGER NOT NULL DEFAULT 0,
+            h2 INTEGER NOT NULL DEFAULT 0,
+            h3 INTEGER NOT NULL DEFAULT 0,
+            h4 INTEGER NOT NULL DEFAULT 0,
+            h5 INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS guild_settings (guild_id INTEGER PRIMARY KEY, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS pending_deletions (
+            channel_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            deadline REAL NOT NULL,
+            PRIMARY KEY (channel_id, message_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            topic TEXT NOT NULL,
+            key INTEGER NOT NULL,
+            origin INTEGER NOT NULL,
+            created REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path: str, shared: bool = False):
+        self.path = path
+        self.shared = shared  # other processes use the same file: publish/poll the changes table
+        self.db = None
+        self._afk_ids = set()  # AFK is small and checked on every message, so its keys stay in memory
+        self._last_change_id = 0
+        self._last_change_trim = 0.0
+
+    def load(self):
+        # isolation_level=None -> autocommit; with WAL + synchronous=NORMAL each write is a cheap append
+        self.db = sqlite3.connect(self.path, isolation_level=None, timeout=SQLITE_BUSY_TIMEOUT)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self._migrate()
+        self.db.executescript(self.SCHEMA)
+        if self.db.execute("SELECT 1 FROM meta WHERE key = 'json_imported'").fetchone() is None:
+            self.import_json()
+        if (self.db.execute("SELECT 1 FROM rating_stats LIMIT 1").fetchone() is None
+                and self.db.execute("SELECT 1 FROM ratings LIMIT 1").fetchone() is not None):
+            self._rebuild_rating_stats()
+        self._afk_ids = {row[0] for row in self.db.execute("SELECT user_id FROM afk")}
+        self._last_change_id = self.db.execute("SELECT COALESCE(MAX(id), 0) FROM changes").fetchone()[0]
+        if self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'mod_log_channels'").fetchone():
+            with self._transaction() as db:
+                for guild_id, channel_id in db.execute("SELECT guild_id, channel_id FROM mod_log_channels").fetchall():
+                    db.execute("INSERT OR IGNORE INTO guild_settings VALUES (?, ?)",
+                               (guild_id, json.dumps({"mod_log_channel": channel_id})))
+                db.execute("DROP TABLE mod_log_channels")
+        if self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'warnings_iso'").fetchone():
+            with self._transaction() as db:
+                db.execute("INSERT INTO warnings SELECT id, guild_id, user_id, moderator_id, reason, "
+                           "COALESCE(CAST(strftime('%s', timestamp) AS INTEGER), 0) FROM warnings_iso")
+                db.execute("DROP TABLE warnings_iso")
+
+    def _migrate(self):
+        """Bring databases created by older versions up to SCHEMA before it is applied."""
+        rating_columns = [row[1] for row in self.db.execute("PRAGMA table_info(ratings)")]
+        if rating_columns and "updated_at" not in rating_columns:
+            self.db.execute("ALTER TABLE ratings ADD COLUMN updated_at REAL NOT NULL DEFAULT 0")
+        afk_columns = [row[1] for row in self.db.execute("PRAGMA table_info(afk)")]
+        if afk_columns and "since" not in afk_columns:
+            self.db.execute("ALTER TABLE afk ADD COLUMN since INTEGER NOT NULL DEFAULT 0")
+            self.db.execute("ALTER TABLE afk ADD COLUMN mentions INTEGER NOT NULL DEFAULT 0")
+        if afk_columns and "guild_id" not in afk_columns:
+            self.db.execute("ALTER TABLE afk ADD COLUMN guild_id INTEGER")
+        warning_types = {row[1]: row[2] for row in self.db.execute("PRAGMA table_info(warnings)")}
+        if warning_types.get("timestamp") == "TEXT":
+            # ISO text timestamps become epoch ints: set the old table aside; load() copies it over
+            with self._transaction() as db:
+                db.execute("DROP INDEX IF EXISTS idx_warnings_member")
+                db.execute("DROP INDEX IF EXISTS idx_warnings_guild_time")
+                db.execute("ALTER TABLE warnings RENAME TO warnings_iso")
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # IMMEDIATE takes the write lock up front: a deferred BEGIN that reads and then writes
+        # gets SQLITE_BUSY at once (no busy wait) if another worker committed in between
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.db
+        except:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def _rebuild_rating_stats(self):
+        with self._transaction() as db:
+            db.execute("DELETE FROM rating_stats")
+            db.execute("""
+                INSERT INTO rating_stats
+                SELECT message_id, COUNT(*), SUM(rating), SUM(rating = 1), SUM(rating = 2),
+                       SUM(rating = 3), SUM(rating = 4), SUM(rating = 5)
+                FROM ratings GROUP BY message_id
+            """)
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def import_json(self):
+        """One-shot import of the legacy JSON files in data/ (the files are left untouched)."""
+        afk = _read_json(AFK_FILE, {})
+        warnings = _read_json(WARNINGS_FILE, {})
+        mod_logs = _read_json(MOD_LOG_FILE, {})
+        ratings = _read_json(RATINGS_FILE, {})
+        cfg = _read_json(CONFIG_FILE, {})
+        with self._transaction() as db:
+            db.executemany("INSERT OR REPLACE INTO afk VALUES (?, ?, ?, ?, ?, ?)",
+                           [(int(uid), d.get('reason', 'AFK'), d.get('original_nick'), d.get('since', 0),
+                             d.get('mentions', 0), d.get('guild_id')) for uid, d in afk.items()])
+            db.executemany(
+                "INSERT INTO warnings (guild_id, user_id, moderator_id, reason, timestamp) VALUES (?, ?, ?, ?, ?)",
+                [(int(gid), int(uid), w.get('moderator'), w.get('reason'), _epoch(w.get('timestamp', 0)))
+                 for gid, users in warnings.items() for uid, ws in users.items() for w in ws])
+            db.executemany("INSERT OR REPLACE INTO guild_settings VALUES (?, ?)",
+                           [(int(gid), json.dumps({"mod_log_channel": int(cid)})) for gid, cid in mod_logs.items()])
+            db.executemany("INSERT OR REPLACE INTO ratings (message_id, user_id, rating) VALUES (?, ?, ?)",
+                           [(int(mid), int(uid), int(r)) for mid, votes in ratings.items() for uid, r in votes.items()])
+            db.executemany("INSERT OR REPLACE INTO config VALUES (?, ?)",
+                           [(k, json.dumps(v)) for k, v in cfg.items()])
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('json_imported', ?)", (datetime.now(TIMEZONE).isoformat(),))
+        print(f"Imported JSON data into {self.path}")
+
+    def get_afk(self, user_id):
+        row = self.db.execute("SELECT reason, original_nick, since, mentions, guild_id FROM afk WHERE user_id = ?",
+                              (user_id,)).fetchone()
+        return AfkEntry(*row) if row else None
+
+    def set_afk(self, user_id, reason, original_nick, guild_id=None):
+        self.db.execute("INSERT OR REPLACE INTO afk VALUES (?, ?, ?, ?, 0, ?)",
+                        (user_id, reason, original_nick, int(time.time()), guild_id))
+        self._afk_ids.add(user_id)
+        self._publish("afk", user_id)
+
+    def pop_afk(self, user_id):
+        data = self.get_afk(user_id)
+        if data is not None:
+            self.db.execute("DELETE FROM afk WHERE user_id = ?", (user_id,))
+            self._publish("afk", user_id)
+        self._afk_ids.discard(user_id)
+        return data
+
+    def get_all_afk(self):
+        rows = self.db.execute("SELECT user_id, reason, original_nick, since, mentions, guild_id FROM afk")
+        return [(row[0], AfkEntry(*row[1:])) for row in rows]
+
+    def is_afk(self, user_id):
+        return user_id in self._afk_ids
+
+    def record_afk_mentions(self, user_ids):
+        self.db.executemany("UPDATE afk SET mentions = mentions + 1 WHERE user_id = ?", [(u,) for u in user_ids])
+
+    def add_warning(self, guild_id, user_id, moderator_id, reason, timestamp):
+        self.db.execute(
+            "INSERT INTO warnings (guild_id, user_id, moderator_id, reason, timestamp) VALUES (?, ?, ?, ?, ?)",
+            (guild_id, user_id, moderator_id, reason, timestamp))
+
+    def get_warnings(self, guild_id, user_id, since=None):
+        rows = self.db.execute(
+            "SELECT moderator_id, reason, timestamp FROM warnings "
+            "WHERE guild_id = ? AND user_id = ? AND timestamp >= ? ORDER BY timestamp",
+            (guild_id, user_id, since.timestamp() if since else 0))
+        return [WarningRecord(*row) for row in rows]
+
+    def count_warnings(self, guild_id, user_id, since=None):
+        return self.db.execute(
+            "SELECT COUNT(*) FROM warnings WHERE guild_id = ? AND user_id = ? AND timestamp >= ?",
+            (guild_id, user_id, since.timestamp() if since else 0)).fetchone()[0]
+
+    def clear_warnings(self, guild_id, user_id):
+        return self.db.execute("DELETE FROM warnings WHERE guild_id = ? AND user_id = ?", (guild_id, user_id)).rowcount
+
+    def purge_warnings_before(self, guild_id, before):
+        return self.db.execute("DELETE FROM warnings WHERE guild_id = ? AND timestamp < ?",
+                               (guild_id, before.timestamp())).rowcount
+
+    def set_rating(self, message_id, user_id, rating):
+        rating = int(rating)  # interpolated into column names below
+        with self._transaction() as db:
+            row = db.execute("SELECT rating FROM ratings WHERE message_id = ? AND user_id = ?",
+                             (message_id, user_id)).fetchone()
+            db.execute("INSERT OR REPLACE INTO ratings VALUES (?, ?, ?, ?)", (message_id, user_id, rating, time.time()))
+            if row is None:
+                db.execute("INSERT OR IGNORE INTO rating_stats (message_id) VALUES (?)", (message_id,))
+                db.execute(f"UPDATE rating_stats SET count = count + 1, total = total + ?, h{rating} = h{rating} + 1 "
+                           "WHERE message_id = ?", (rating, message_id))
+            elif row[0] != rating:
+                previous = int(row[0])
+                db.execute(f"UPDATE rating_stats SET total = total + ?, h{previous} = h{previous} - 1, "
+                           f"h{rating} = h{rating} + 1 WHERE message_id = ?", (rating - previous, message_id))
+
+    def get_ratings(self, message_id):
+        return dict(self.db.execute("SELECT user_id, rating FROM ratings WHERE message_id = ?", (message_id,)))
+
+    def get_rating_summary(self, message_id):
+        row = self.db.execute("SELECT count, total, h1, h2, h3, h4, h5 FROM rating_stats WHERE message_id = ?",
+                              (message_id,)).fetchone() or (0, 0, 0, 0, 0, 0, 0)
+        recent = self.db.execute(
+            "SELECT user_id, rating FROM ratings WHERE message_id = ? ORDER BY updated_at DESC LIMIT ?",
+            (message_id, RATING_RECENT_VOTERS)).fetchall()
+        return {'count': row[0], 'total': row[1], 'histogram': list(row[2:]), 'recent': recent}
+
+    def load_guild_settings(self, guild_id):
+        row = self.db.execute("SELECT data FROM guild_settings WHERE guild_id = ?", (guild_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_guild_settings(self, guild_id, settings):
+        self.db.execute("INSERT OR REPLACE INTO guild_settings VALUES (?, ?)", (guild_id, json.dumps(settings)))
+        self._publish("guild_settings", guild_id)
+
+    def get_config(self, key, default=None):
+        row = self.db.execute("SELECT value FROM config WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_config(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO config VALUES (?, ?)", (key, json.dumps(value)))
+
+    def add_pending_deletion(self, channel_id, message_id, deadline):
+        self.db.execute("INSERT OR REPLACE INTO pending_deletions VALUES (?, ?, ?)", (channel_id, message_id, deadline))
+
+    def remove_pending_deletions(self, keys):
+        self.db.executemany("DELETE FROM pending_deletions WHERE channel_id = ? AND message_id = ?", keys)
+
+    def get_pending_deletions(self):
+        return self.db.execute("SELECT deadline, channel_id, message_id FROM pending_deletions").fetchall()
+
+    # Warnings and ratings are always read from the database, so only the in-memory AFK ids
+    # and callers' caches (guild settings) need to hear about other processes' writes.
+    def _publish(self, topic, key):
+        if self.shared:
+            self.db.execute("INSERT INTO changes (topic, key, origin, created) VALUES (?, ?, ?, ?)",
+                            (topic, key, os.getpid(), time.time()))
+
+    def poll_changes(self):
+        if not self.shared:
+            return []
+        rows = self.db.execute("SELECT id, topic, key, origin FROM changes WHERE id > ? ORDER BY id",
+                               (self._last_change_id,)).fetchall()
+        changes = []
+        for change_id, topic, key, origin in rows:
+            self._last_change_id = change_id
+            if origin == os.getpid():
+                continue
+            if topic == "afk":
+                if self.db.execute("SELECT 1 FROM afk WHERE user_id = ?", (key,)).fetchone():
+                    self._afk_ids.add(key)
+                else:
+                    self._afk_ids.discard(key)
+            changes.append((topic, key))
+        now = time.time()
+        if now - self._last_change_trim > 60:
+            self._last_change_trim = now
+            self.db.execute("DELETE FROM changes WHERE created < ?", (now - CLUSTER_CHANGES_RETENTION,))
+        return changes
+
+
+if CLUSTER_WORKER is not None:
+    storage = SqliteStorage(SQLITE_FILE, shared=True)  # the launcher forces sqlite for workers
+elif STORAGE_BACKEND == "sqlite":
+    storage = SqliteStorage(SQLITE_FILE)
+else:
+    storage = JsonStorage()
+
+def load_data():
+    storage.load()
+
+@tasks.loop(seconds=FLUSH_INTERVAL)
+async def flush_data_task():
+    with metrics.timer("area69_storage_flush_seconds", backend=type(storage).__name__):
+        await storage.flush()
+
+@tasks.loop(seconds=CLUSTER_SYNC_INTERVAL)
+async def cluster_sync_task():
+    """Apply other workers' writes to this process's caches."""
+    for topic, key in storage.poll_changes():
+        if topic == "guild_settings":
+            _guild_settings_cache.pop(key, None)
 
 # ========= Helpers =========
 def create_embed(title: str, description: str, color: discord.Color) -> discord.Embed:
@@ -103,38 +1035,332 @@ def create_embed(title: str, description: str, color: discord.Color) -> discord.
     embed.set_footer(text="Area 69")
     return embed
 
-async def send_temp_message(ctx_or_channel, embed: discord.Embed):
-    """Auto-delete after 30s (used for moderation/AFK/help)."""
-    # ctx_or_channel can be ctx or a channel
-    if hasattr(ctx_or_channel, "send"):
-        msg = await ctx_or_channel.send(embed=embed)
+def parse_duration(duration: str):
+    """Parse '30s', '5min', '1hour', '7days' into (timedelta, display text); raises ValueError."""
+    num_str = ''
+    for ch in duration:
+        if ch.isdigit():
+            num_str += ch
+        else:
+            break
+    value = int(num_str)
+    unit = duration[len(num_str):].lower()
+
+    if unit in ['s', 'sec', 'second', 'seconds']:
+        delta = timedelta(seconds=value)
+        unit_display = f"{value} second{'s' if value != 1 else ''}"
+    elif unit in ['m', 'min', 'minute', 'minutes']:
+        delta = timedelta(minutes=value)
+        unit_display = f"{value} minute{'s' if value != 1 else ''}"
+    elif unit in ['h', 'hour', 'hours']:
+        delta = timedelta(hours=value)
+        unit_display = f"{value} hour{'s' if value != 1 else ''}"
+    elif unit in ['d', 'day', 'days']:
+        delta = timedelta(days=value)
+        unit_display = f"{value} day{'s' if value != 1 else ''}"
     else:
-        # ctx
-        msg = await ctx_or_channel.send(embed=embed)
-    await asyncio.sleep(DELETE_DELAY)
-    try:
-        await msg.delete()
-    except:
-        pass
-    # If it's a ctx, try delete the invoking msg too
-    try:
-        if hasattr(ctx_or_channel, "message"):
-            await ctx_or_channel.message.delete()
-    except:
-        pass
+        raise ValueError(f"unknown duration unit: {unit!r}")
+    return delta, unit_display
+
+# ========= Per-guild settings =========
+class GuildSettings:
+    """Settings for one guild, cached in memory and written back through storage on save()."""
+
+    def __init__(self, guild_id: int, data: dict):
+        self.guild_id = guild_id
+        self.rating_channels = set(data.get("rating_channels", []))
+        self.mod_log_channel = data.get("mod_log_channel")
+        self.max_warnings = data.get("max_warnings", MAX_WARNINGS)
+        self.warning_timeout = timedelta(seconds=data.get("warning_timeout", WARNING_TIMEOUT.total_seconds()))
+        self.delete_delay = data.get("delete_delay", DELETE_DELAY)
+        self.warning_expiry = timedelta(seconds=data.get("warning_expiry", WARNING_EXPIRY.total_seconds()))
+
+    def warnings_since(self) -> Optional[datetime]:
+        """Oldest timestamp of a warning that still counts, or None if warnings never expire."""
+        return datetime.now(TIMEZONE) - self.warning_expiry if self.warning_expiry else None
+
+    def to_dict(self) -> dict:
+        return {
+            "rating_channels": sorted(self.rating_channels),
+            "mod_log_channel": self.mod_log_channel,
+            "max_warnings": self.max_warnings,
+            "warning_timeout": int(self.warning_timeout.total_seconds()),
+            "delete_delay": self.delete_delay,
+            "warning_expiry": int(self.warning_expiry.total_seconds()),
+        }
+
+    def save(self):
+        storage.save_guild_settings(self.guild_id, self.to_dict())
+
+_guild_settings_cache = {}  # {guild_id: GuildSettings}
+
+def guild_settings(guild_id: int) -> GuildSettings:
+    """Settings for a guild, loaded from storage on first use and cached afterwards."""
+    settings = _guild_settings_cache.get(guild_id)
+    if settings is None:
+        settings = _guild_settings_cache[guild_id] = GuildSettings(guild_id, storage.load_guild_settings(guild_id) or {})
+        # Adopt the old process-wide ratings channel if it belongs to this guild
+        legacy_channel_id = storage.get_config("edit_channel_id")
+        legacy_channel = bot.get_channel(legacy_channel_id) if legacy_channel_id else None
+        if legacy_channel is not None and getattr(legacy_channel, "guild", None) and legacy_channel.guild.id == guild_id:
+            settings.rating_channels.add(legacy_channel_id)
+            settings.save()
+            storage.set_config("edit_channel_id", None)
+    return settings
+
+@tasks.loop(hours=1)
+async def compact_warnings_task():
+    """Drop expired warnings so the ledger only holds ones that can still count."""
+    for guild in bot.guilds:
+        since = guild_settings(guild.id).warnings_since()
+        if since:
+            removed = storage.purge_warnings_before(guild.id, since)
+            if removed:
+                print(f"Compacted {removed} expired warnings in {guild.name}")
+
+# ========= HTTP client =========
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', 10))  # seconds per request, connect included
+HTTP_POOL_LIMIT = 50           # open connections in total
+HTTP_POOL_LIMIT_PER_HOST = 10  # open connections per upstream host
+IMAGE_BUFFER_SIZE = 5          # image URLs kept ready per provider
+
+class HttpClient:
+    """One pooled aiohttp session for the lifetime of the bot."""
+
+    def __init__(self):
+        self.session = None
+
+    async def start(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=HTTP_POOL_LIMIT, limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+                                               ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+            )
 
-async def log_action(guild: discord.Guild, action: str, moderator: discord.Member,
-                     target: Union[discord.Member, discord.User, discord.TextChannel], reason: str = None):
-    gid = str(guild.id)
-    if gid not in mod_log_channels:
-        return
-    channel = guild.get_channel(mod_log_channels[gid])
-    if not channel:
+    async def get_json(self, url: str):
+        await self.start()
+        async with self.session.get(url) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+http_client = HttpClient()
+
+
+class ImageBuffer:
+    """A few ready-to-use image URLs from one provider, topped up in the background."""
+
+    def __init__(self, url: str, extract):
+        self.url = url
+        self.extract = extract  # response JSON -> list of image URLs
+        self.urls = collections.deque(maxlen=IMAGE_BUFFER_SIZE)
+        self._refill_task = None
+
+    async def get(self) -> str:
+        if self.urls:
+            url = self.urls.popleft()
+        else:
+            urls = self.extract(await http_client.get_json(self.url))
+            url = urls[0]
+            self.urls.extend(urls[1:])
+        self.refill()
+        return url
+
+    def refill(self):
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.create_task(self._refill())
+
+    async def _refill(self):
+        while len(self.urls) < self.urls.maxlen:
+            try:
+                self.urls.extend(self.extract(await http_client.get_json(self.url)))
+            except Exception as e:
+                print(f"Error prefetching images from {self.url}: {e!r}")
+                return
+
+image_buffers = {
+    "cat": ImageBuffer(f'https://api.thecatapi.com/v1/images/search?limit={IMAGE_BUFFER_SIZE}',
+                       lambda data: [image['url'] for image in data]),
+    "dog": ImageBuffer(f'https://dog.ceo/api/breeds/image/random/{IMAGE_BUFFER_SIZE}',
+                       lambda data: data['message']),
+}
+
+# ========= Auto-delete scheduler =========
+DELETE_BATCH_WINDOW = 1.0  # seconds; deletions due this close together go out as one bulk delete
+
+class DeletionScheduler:
+    """One background task that deletes messages once their deadline passes.
+
+    Deadlines live in a heap (plus storage, so they survive restarts); due messages are
+    grouped per channel and removed with bulk deletes where possible.
+    """
+
+    def __init__(self):
+        self._heap = []      # [(deadline, channel_id, message_id)]
+        self._pending = {}   # {(channel_id, message_id): deadline}; heap entries not matching are stale
+        self._wakeup = None
+        self._task = None
+
+    def schedule(self, message: discord.Message, delay: Optional[float] = None):
+        self._push(time.time() + (DELETE_DELAY if delay is None else delay), message.channel.id, message.id)
+        storage.add_pending_deletion(message.channel.id, message.id, self._pending[(message.channel.id, message.id)])
+
+    def _push(self, deadline, channel_id, message_id):
+        key = (channel_id, message_id)
+        if key in self._pending and self._pending[key] <= deadline:
+            return
+        self._pending[key] = deadline
+        heapq.heappush(self._heap, (deadline, channel_id, message_id))
+        if self._wakeup is not None and self._heap[0][0] == deadline:
+            self._wakeup.set()
+
+    def start(self):
+        if self._task is not None and not self._task.done():
+            return
+        self._wakeup = asyncio.Event()
+        for deadline, channel_id, message_id in storage.get_pending_deletions():
+            # In a cluster each worker takes its own channels; shard 0 (which gets DMs) also
+            # takes channels nobody has cached, at worst deleting twice (a harmless 404).
+            if CLUSTER_WORKER is not None and bot.get_channel(channel_id) is None and 0 not in bot.shard_ids:
+                continue
+            self._push(deadline, channel_id, message_id)
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            if self._heap and self._heap[0][0] <= now:
+                by_channel = {}
+                while self._heap and self._heap[0][0] <= now + DELETE_BATCH_WINDOW:
+                    deadline, channel_id, message_id = heapq.heappop(self._heap)
+                    if self._pending.get((channel_id, message_id)) != deadline:
+                        continue  # superseded entry
+                    del self._pending[(channel_id, message_id)]
+                    by_channel.setdefault(channel_id, []).append(message_id)
+                for channel_id, message_ids in by_channel.items():
+                    try:
+                        await self._delete(channel_id, message_ids)
+                    except Exception as e:
+                        print(f"Error auto-deleting messages in {channel_id}: {e}")
+                    storage.remove_pending_deletions([(channel_id, m) for m in message_ids])
+                continue
+
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _delete(self, channel_id: int, message_ids: list):
+        channel = bot.get_channel(channel_id) or bot.get_partial_messageable(channel_id)
+        for i in range(0, len(message_ids), 100):
+            chunk = message_ids[i:i + 100]
+            if len(chunk) > 1 and hasattr(channel, "delete_messages"):
+                try:
+                    await channel.delete_messages([discord.Object(id=m) for m in chunk])
+                    continue
+                except discord.HTTPException:
+                    pass  # e.g. no manage_messages; fall back to one by one
+            for message_id in chunk:
+                try:
+                    await channel.get_partial_message(message_id).delete()
+                except:
+                    pass
+
+delete_scheduler = DeletionScheduler()
+
+async def send_temp_message(ctx_or_channel, embed: discord.Embed):
+    """Send an embed that auto-deletes after the guild's delete delay (used for moderation/AFK/help).
+
+    Returns right after sending; for a ctx the invoking message is scheduled for deletion too.
+    """
+    msg = await ctx_or_channel.send(embed=embed)
+    guild = getattr(ctx_or_channel, "guild", None)
+    delay = guild_settings(guild.id).delete_delay if guild else DELETE_DELAY
+    delete_scheduler.schedule(msg, delay)
+    if hasattr(ctx_or_channel, "message"):
+        delete_scheduler.schedule(ctx_or_channel.message, delay)
+    return msg
+
+# ========= Mod log =========
+MOD_LOG_BATCH_SIZE = 10     # embeds per message (Discord's limit)
+MOD_LOG_BATCH_CHARS = 6000  # total embed characters per message (Discord's limit)
+MOD_LOG_FLUSH_DELAY = 2.0   # seconds to wait for more entries before sending a partial batch
+MOD_LOG_MAX_RETRIES = 5
+
+class ModLogQueue:
+    """Per-guild queues of mod-log embeds, each drained by a background worker that packs
+    up to MOD_LOG_BATCH_SIZE embeds into one message."""
+
+    def __init__(self):
+        self._queues = {}   # {guild_id: deque of embeds}
+        self._full = {}     # {guild_id: event set once a full batch is waiting}
+        self._workers = {}  # {guild_id: drain task}
+
+    def put(self, guild_id: int, embed: discord.Embed):
+        queue = self._queues.setdefault(guild_id, collections.deque())
+        queue.append(embed)
+        if guild_id not in self._workers:
+            self._full[guild_id] = asyncio.Event()
+            self._workers[guild_id] = asyncio.create_task(self._drain(guild_id))
+        if len(queue) >= MOD_LOG_BATCH_SIZE:
+            self._full[guild_id].set()
+
+    async def _drain(self, guild_id: int):
+        queue, full = self._queues[guild_id], self._full[guild_id]
+        try:
+            while queue:
+                if len(queue) < MOD_LOG_BATCH_SIZE:
+                    try:
+                        await asyncio.wait_for(full.wait(), MOD_LOG_FLUSH_DELAY)
+                    except asyncio.TimeoutError:
+                        pass
+                full.clear()
+                batch, chars = [], 0
+                while queue and len(batch) < MOD_LOG_BATCH_SIZE and (not batch or chars + len(queue[0]) <= MOD_LOG_BATCH_CHARS):
+                    chars += len(queue[0])
+                    batch.append(queue.popleft())
+                await self._send(guild_id, batch)
+        finally:
+            del self._workers[guild_id], self._full[guild_id]
+            if not queue:
+                del self._queues[guild_id]
+
+    async def _send(self, guild_id: int, batch: list):
+        guild = bot.get_guild(guild_id)
+        channel_id = guild_settings(guild_id).mod_log_channel
+        channel = guild.get_channel(channel_id) if guild and channel_id else None
+        if not channel:
+            return
+        for attempt in range(MOD_LOG_MAX_RETRIES):
+            try:
+                await channel.send(embeds=batch)
+                return
+            except Exception as e:  # a failed send must not end the drain task and lose the batch
+                transient = (isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError, OSError))
+                             or isinstance(e, discord.HTTPException) and (e.status == 429 or e.status >= 500))
+                if not transient:
+                    print(f"Error sending mod log in {guild_id}: {e!r}")
+                    return
+                await asyncio.sleep(getattr(e, "retry_after", None) or min(2 ** attempt, 30))
+        print(f"Dropped {len(batch)} mod log entries in {guild_id} after {MOD_LOG_MAX_RETRIES} attempts")
+
+mod_log_queue = ModLogQueue()
+
+def log_action(guild: discord.Guild, action: str, moderator: discord.Member,
+               target: Union[discord.Member, discord.User, discord.TextChannel, str], reason: str = None):
+    """Queue a mod-log entry; never waits on Discord."""
+    if guild_settings(guild.id).mod_log_channel is None:
         return
 
-    if action.lower() in ['ban', 'warn']:
+    if action.lower() in ['ban', 'warn', 'mass ban']:
         color = discord.Color.red()
-    elif action.lower() in ['kick', 'timeout']:
+    elif action.lower() in ['kick', 'timeout', 'mass kick', 'mass timeout']:
         color = discord.Color.orange()
     elif action.lower() in ['clear', 'removetimeout']:
         color = discord.Color.blue()
@@ -143,6 +1369,8 @@ async def log_action(guild: discord.Guild, action: str, moderator: discord.Membe
 
     if isinstance(target, (discord.Member, discord.User)):
         target_desc = f"{target.mention} ({target.id})"
+    elif isinstance(target, str):
+        target_desc = target
     else:
         target_desc = f"#{target.name}"
 
@@ -156,15 +1384,12 @@ async def log_action(guild: discord.Guild, action: str, moderator: discord.Membe
     )
 
     # Add warnings count if applicable
-    gid = str(guild.id)
-    if action.lower() == 'warn' and gid in user_warnings:
-        # If target is a user/member
-        if isinstance(target, (discord.Member, discord.User)):
-            uid = str(target.id)
-            if uid in user_warnings[gid]:
-                embed.add_field(name="Total Warnings", value=str(len(user_warnings[gid][uid])))
+    if action.lower() == 'warn' and isinstance(target, (discord.Member, discord.User)):
+        active = storage.count_warnings(guild.id, target.id, guild_settings(guild.id).warnings_since())
+        if active:
+            embed.add_field(name="Active Warnings", value=str(active))
 
-    await channel.send(embed=embed)
+    mod_log_queue.put(guild.id, embed)
 
 async def show_command_help(ctx):
     """Show command usage for authorized users; roast for normals."""
@@ -194,14 +1419,14 @@ async def show_command_help(ctx):
         await ctx.send(embed=embed)
 
 # ========= Rating System =========
-def make_rating_embed(author: discord.Member, message_id: int):
-    """Generate rating embed showing averages + user ratings."""
-    ratings = edit_ratings.get(message_id, {})
-    votes = len(ratings)
-    avg = sum(ratings.values()) / votes if votes > 0 else 0
+def make_rating_embed(author_name: str, message_id: int):
+    """Generate rating embed showing the average, a star histogram and the latest voters."""
+    summary = storage.get_rating_summary(message_id)
+    votes = summary['count']
+    avg = summary['total'] / votes if votes > 0 else 0
 
     embed = discord.Embed(
-        title=f"➜ {author.display_name}'s Edit ",
+        title=f"➜ {author_name}'s Edit ",
         description="Rate this edit below",
         color=discord.Color.blue(),
         timestamp=datetime.now(TIMEZONE)
@@ -210,116 +1435,578 @@ def make_rating_embed(author: discord.Member, message_id: int):
 
     embed.add_field(name="★ Current Rating", value=f"Score: {avg:.1f}/5\nVotes: {votes} votes", inline=False)
 
-    if ratings:
-        user_lines = []
-        for uid, rating in ratings.items():
-            stars = "★" * rating + "☆" * (5 - rating)
-            user = author.guild.get_member(uid)
-            if user:
-                user_lines.append(f"{user.display_name}: {stars}")
-        if user_lines:
-            embed.add_field(name="👥 User Ratings", value="\n".join(user_lines), inline=False)
+    if votes:
+        top = max(summary['histogram'])
+        bars = []
+        for stars in range(5, 0, -1):
+            count = summary['histogram'][stars - 1]
+            bars.append(f"{stars} ★ `{'█' * round(10 * count / top):<10}` {count}")
+        embed.add_field(name="📊 Breakdown", value="\n".join(bars), inline=False)
+
+        # Mentions render as names client-side, so no member lookups per voter
+        user_lines = [f"<@{uid}>: {'★' * rating}{'☆' * (5 - rating)}" for uid, rating in summary['recent']]
+        if votes > len(user_lines):
+            user_lines.append(f"…and {votes - len(user_lines)} more")
+        embed.add_field(name="👥 Latest Ratings", value="\n".join(user_lines), inline=False)
 
     return embed
 
 
-class RatingView(discord.ui.View):
-    def __init__(self, author: discord.Member, message_id: int):
-        super().__init__(timeout=None)
-        self.author = author
+class RatingButton(discord.ui.DynamicItem[discord.ui.Button],
+                   template=r"rate:(?P<author_id>[0-9]+):(?P<message_id>[0-9]+):(?P<rating>[1-5])"):
+    """One star button. Its custom ID encodes the rated message, so clicks are routed
+    without a per-message View in memory and keep working across restarts."""
+
+    def __init__(self, author_id: int, message_id: int, rating: int):
+        super().__init__(discord.ui.Button(
+            label=f"{rating} ★",
+            style=discord.ButtonStyle.secondary,
+            custom_id=f"rate:{author_id}:{message_id}:{rating}",
+        ))
+        self.author_id = author_id
         self.message_id = message_id
+        self.rating = rating
 
-    @discord.ui.button(label="1 ★", style=discord.ButtonStyle.secondary)
-    async def one(self, interaction: discord.Interaction, button: discord.ui.Button):
-        await self.handle_vote(interaction, 1)
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match):
+        return cls(int(match["author_id"]), int(match["message_id"]), int(match["rating"]))
 
-    @discord.ui.button(label="2 ★", style=discord.ButtonStyle.secondary)
-    async def two(self, interaction: discord.Interaction, button: discord.ui.Button):
-        await self.handle_vote(interaction, 2)
+    async def callback(self, interaction: discord.Interaction):
+        await self.handle_vote(interaction, self.rating)
 
-    @discord.ui.button(label="3 ★", style=discord.ButtonStyle.secondary)
-    async def three(self, interaction: discord.Interaction, button: discord.ui.Button):
-        await self.handle_vote(interaction, 3)
+    async def handle_vote(self, interaction: discord.Interaction, rating: int):
+        storage.set_rating(self.message_id, interaction.user.id, rating)
 
-    @discord.ui.button(label="4 ★", style=discord.ButtonStyle.secondary)
-    async def four(self, interaction: discord.Interaction, button: discord.ui.Button):
-        await self.handle_vote(interaction, 4)
+        # Acknowledge right away; the embed edit is coalesced with other votes
+        await interaction.response.defer()
+        rating_refresher.request(interaction.message, self.author_id, self.message_id)
 
-    @discord.ui.button(label="5 ★", style=discord.ButtonStyle.secondary)
-    async def five(self, interaction: discord.Interaction, button: discord.ui.Button):
-        await self.handle_vote(interaction, 5)
+bot.add_dynamic_items(RatingButton)
 
-    async def handle_vote(self, interaction: discord.Interaction, rating: int):
-        user_id = interaction.user.id
-        if self.message_id not in edit_ratings:
-            edit_ratings[self.message_id] = {}
-        edit_ratings[self.message_id][user_id] = rating
-        save_data()
 
-        # Update embed
-        embed = make_rating_embed(self.author, self.message_id)
-        await interaction.response.edit_message(embed=embed, view=self)
+class RatingRefresher:
+    """Coalesces rating embed edits: at most one edit per RATING_REFRESH_WINDOW per message.
+
+    The first vote edits immediately; votes arriving during the window trigger a single
+    trailing edit with the latest aggregate.
+    """
+
+    def __init__(self):
+        self._tasks = {}     # {rating message id: refresh task}
+        self._dirty = set()  # rating message ids that got votes since their last edit
+
+    def request(self, message: discord.Message, author_id: int, rated_message_id: int):
+        if message.id in self._tasks:
+            self._dirty.add(message.id)
+        else:
+            self._tasks[message.id] = asyncio.create_task(self._run(message, author_id, rated_message_id))
+
+    async def _run(self, message: discord.Message, author_id: int, rated_message_id: int):
+        try:
+            while True:
+                self._dirty.discard(message.id)
+                # Keep the current title if the author left or isn't cached
+                author = find_member(message.guild, author_id) if message.guild else None
+                embed = make_rating_embed(author.display_name if author else "Someone", rated_message_id)
+                if not author and message.embeds:
+                    embed.title = message.embeds[0].title
+                try:
+                    await message.edit(embed=embed)
+                except discord.HTTPException as e:
+                    print(f"Error refreshing rating embed {message.id}: {e}")
+                await asyncio.sleep(RATING_REFRESH_WINDOW)
+                if message.id not in self._dirty:
+                    break
+        finally:
+            del self._tasks[message.id]
+
+rating_refresher = RatingRefresher()
+
+def rating_view(author_id: int, message_id: int) -> discord.ui.View:
+    """Build the 1-5 star buttons for a rated message."""
+    view = discord.ui.View(timeout=None)
+    for rating in range(1, 6):
+        view.add_item(RatingButton(author_id, message_id, rating))
+    view.stop()  # clicks are dispatched through RatingButton, so don't keep this view in the view store
+    return view
+
+# ========= Member cache =========
+RECENT_MEMBERS_MAX = 5000                  # members kept in minimal-cache mode
+RECENT_MEMBERS_TTL = timedelta(hours=6)    # ...for at most this long since last seen
+
+class RecentMembers:
+    """Bounded LRU of members seen recently (joiners, chatters) for MEMBER_CACHE=minimal.
+
+    Stands in for the full member cache where the bot only needs members it has just
+    seen: the `joined:` raid selector, rating embed titles and AFK users coming back.
+    """
+
+    def __init__(self, max_size: int = RECENT_MEMBERS_MAX, ttl: timedelta = RECENT_MEMBERS_TTL):
+        self.max_size = max_size
+        self.ttl = ttl.total_seconds()
+        self._members = collections.OrderedDict()  # (guild_id, user_id) -> (member, last seen)
+
+    def __len__(self):
+        return len(self._members)
+
+    def remember(self, member: discord.Member):
+        key = (member.guild.id, member.id)
+        self._members[key] = (member, time.monotonic())
+        self._members.move_to_end(key)
+        while len(self._members) > self.max_size:
+            self._members.popitem(last=False)
+
+    def forget(self, guild_id: int, user_id: int):
+        self._members.pop((guild_id, user_id), None)
+
+    def get(self, guild_id: int, user_id: int) -> Optional[discord.Member]:
+        entry = self._members.get((guild_id, user_id))
+        if entry is None:
+            return None
+        if time.monotonic() - entry[1] > self.ttl:
+            del self._members[(guild_id, user_id)]
+            return None
+        return entry[0]
+
+    def in_guild(self, guild_id: int) -> list:
+        cutoff = time.monotonic() - self.ttl
+        return [member for (gid, _), (member, seen) in self._members.items() if gid == guild_id and seen >= cutoff]
+
+recent_members = RecentMembers()
+
+def find_member(guild: discord.Guild, user_id: int) -> Optional[discord.Member]:
+    """Cached member lookup that also checks recent_members (no API call)."""
+    return guild.get_member(user_id) or recent_members.get(guild.id, user_id)
+
+def members_joined_since(guild: discord.Guild, cutoff: datetime) -> list:
+    """Members (cached or recently seen) who joined at/after cutoff."""
+    members = {m.id: m for m in recent_members.in_guild(guild.id)}
+    members.update((m.id, m) for m in guild.members)
+    return [m for m in members.values() if m.joined_at and m.joined_at >= cutoff]
+
+def process_rss_mb() -> float:
+    """Resident set size of this process in MiB (peak RSS where /proc isn't available)."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# ========= Rate limiting =========
+def _parse_rate(value: str) -> tuple:
+    """"8/30" -> (capacity 8, refill 8 tokens per 30 seconds) as (capacity, tokens per second)."""
+    tokens, _, seconds = value.partition("/")
+    return float(tokens), float(tokens) / float(seconds or 1)
+
+# Token buckets per user, channel and guild: "<burst>/<seconds to refill it>"
+RATE_LIMITS = {
+    "user": _parse_rate(os.getenv("RATE_LIMIT_USER", "8/30")),
+    "channel": _parse_rate(os.getenv("RATE_LIMIT_CHANNEL", "20/30")),
+    "guild": _parse_rate(os.getenv("RATE_LIMIT_GUILD", "60/30")),
+}
+# Tokens per use; anything not listed costs 1. Chat mentions hit Groq, images hit external APIs.
+RATE_LIMIT_COSTS = {"chat": 4, "cat": 2, "dog": 2}
+RATE_LIMIT_COSTS.update((name.strip(), float(cost)) for name, _, cost in
+                        (item.partition("=") for item in os.getenv("RATE_LIMIT_COSTS", "").split(",") if item))
+RATE_LIMIT_MAX_BUCKETS = 50_000
+
+class RateLimiter:
+    """Token buckets in one LRU OrderedDict; O(1) per check.
+
+    A bucket idle long enough to be full again is the same as no bucket, so the oldest
+    entries are evicted once they reach that age (and always beyond max_buckets).
+    """
+
+    def __init__(self, limits: dict, max_buckets: int = RATE_LIMIT_MAX_BUCKETS):
+        self.limits = limits  # {scope: (capacity, tokens per second)}
+        self.max_buckets = max_buckets
+        self.idle_after = max(capacity / rate for capacity, rate in limits.values())
+        self._buckets = collections.OrderedDict()  # (scope, id) -> [tokens, last update]
+        self._notified = collections.OrderedDict()  # {user_id: time until which "slow down" isn't repeated}
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _bucket(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.limits[key[0]][0], now]
+        else:
+            capacity, rate = self.limits[key[0]]
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def _evict(self, now):
+        while self._buckets:
+            key, (tokens, last) = next(iter(self._buckets.items()))
+            if len(self._buckets) <= self.max_buckets and now - last < self.idle_after:
+                break
+            del self._buckets[key]
+
+    def consume(self, cost: float, user_id: int, channel_id: Optional[int], guild_id: Optional[int]) -> float:
+        """Take `cost` tokens from every bucket, or none; return 0 or seconds until it would fit."""
+        now = time.monotonic()
+        self._evict(now)
+        keys = [("user", user_id)]
+        if channel_id is not None:
+            keys.append(("channel", channel_id))
+        if guild_id is not None:
+            keys.append(("guild", guild_id))
+        buckets = [(self._bucket(key, now), *self.limits[key[0]]) for key in keys]
+        retry_after = max((min(cost, capacity) - bucket[0]) / rate for bucket, capacity, rate in buckets)
+        if retry_after > 0:
+            metrics.inc("area69_rate_limited_total")
+            return retry_after
+        for bucket, _, _ in buckets:
+            bucket[0] -= cost
+        return 0.0
+
+    def should_notify(self, user_id: int, retry_after: float) -> bool:
+        """True once per throttled stretch, so the warnings themselves don't become spam."""
+        now = time.monotonic()
+        if self._notified.get(user_id, 0) > now:
+            return False
+        # Deadlines differ per user, so the front entry isn't necessarily the first to expire;
+        # only trim what has expired there (or overflow), and judge each user by their own deadline.
+        while self._notified and (next(iter(self._notified.values())) <= now
+                                  or len(self._notified) >= self.max_buckets):
+            self._notified.popitem(last=False)
+        self._notified.pop(user_id, None)
+        self._notified[user_id] = now + retry_after
+        return True
+
+rate_limiter = RateLimiter(RATE_LIMITS)
+
+class RateLimited(commands.CheckFailure):
+    def __init__(self, retry_after: float):
+        super().__init__(f"Rate limited for {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+def rate_limit_exempt(member) -> bool:
+    """Moderators and the owner are never throttled (raid cleanup must not stall)."""
+    permissions = getattr(member, "guild_permissions", None)
+    return str(member.id) == SERVER_OWNER_ID or bool(permissions and permissions.manage_messages)
+
+async def send_slow_down(destination, user_id: int, retry_after: float):
+    """The one "slow down" reply used by commands and the chatbot."""
+    if rate_limiter.should_notify(user_id, retry_after):
+        await send_temp_message(destination, create_embed(
+            "🐢 Slow down", f"<@{user_id}>, you're going too fast. Try again in {max(1, round(retry_after))}s.",
+            discord.Color.orange()))
+
+@bot.check
+async def rate_limit_check(ctx):
+    if rate_limit_exempt(ctx.author):
+        return True
+    retry_after = rate_limiter.consume(RATE_LIMIT_COSTS.get(ctx.command.qualified_name, 1), ctx.author.id,
+                                       ctx.channel.id, ctx.guild.id if ctx.guild else None)
+    if retry_after:
+        raise RateLimited(retry_after)
+    return True
+
+# ========= AFK nicknames =========
+NICK_EDIT_INTERVAL = 0.5  # seconds between nickname edits (member edits share a per-guild rate limit)
+NICK_MAX_RETRIES = 5
+NICK_QUERY_CHUNK = 100    # user IDs per gateway member query (Discord's limit)
+
+def afk_nick(name: str) -> str:
+    return f"{AFK_PREFIX} {name}"[:32]
+
+def strip_afk_nick(nick: str) -> Optional[str]:
+    """Nickname without the AFK prefix (None: drop the nickname entirely)."""
+    return (nick[len(AFK_PREFIX):].strip() or None) if nick.startswith(AFK_PREFIX) else nick
+
+class NicknameWorker:
+    """Applies AFK nickname changes in the background, one at a time.
+
+    Requests are coalesced per member (only the newest wanted nickname is applied) and
+    failed edits are retried with backoff; members who left or outrank the bot are
+    dropped. reconcile() fixes nicknames that drifted from the AFK list, e.g. when the
+    bot was restarted before an edit went through.
+    """
+
+    def __init__(self):
+        self._wanted = {}  # {(guild_id, user_id): [nick, attempts, not before (monotonic)]}
+        self._wakeup = None
+        self._task = None
+        self.reconciled = False
+
+    def enqueue(self, guild_id: int, user_id: int, nick: Optional[str]):
+        self._wanted[(guild_id, user_id)] = [nick, 0, 0.0]
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def start(self):
+        if self._task is not None and not self._task.done():
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            due = [key for key, (_, _, not_before) in self._wanted.items() if not_before <= now]
+            if not due:
+                self._wakeup.clear()
+                timeout = min((entry[2] for entry in self._wanted.values()), default=None)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), None if timeout is None else timeout - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            for key in due:
+                entry = self._wanted.get(key)
+                if entry is None or entry[2] > loop.time():
+                    continue  # replaced by a newer request meanwhile
+                try:
+                    await self._apply(*key, entry[0])
+                except Exception as e:  # one bad edit must never stop the worker
+                    transient = (isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError, OSError))
+                                 or isinstance(e, discord.HTTPException) and (e.status == 429 or e.status >= 500))
+                    if transient and entry[1] + 1 < NICK_MAX_RETRIES:
+                        entry[1] += 1  # a newer request for this member replaces the entry anyway
+                        entry[2] = loop.time() + 2 ** entry[1]
+                        continue
+                    print(f"Giving up on nickname for {key[1]} in {key[0]}: {e!r}")
+                if self._wanted.get(key) is entry:
+                    del self._wanted[key]
+                await asyncio.sleep(NICK_EDIT_INTERVAL)
+
+    async def _apply(self, guild_id: int, user_id: int, nick: Optional[str]):
+        guild = bot.get_guild(guild_id)
+        if guild is None:
+            return  # not on this shard, or the bot left
+        try:
+            member = find_member(guild, user_id) or await guild.fetch_member(user_id)
+        except discord.NotFound:
+            return  # they left
+        if member.nick == nick or (nick is not None and member.display_name == nick):
+            return
+        if member.id == guild.owner_id or member.top_role >= guild.me.top_role:
+            return  # Discord won't let us rename them
+        try:
+            await member.edit(nick=nick, reason="AFK status")
+        except (discord.Forbidden, discord.NotFound) as e:  # not worth retrying, but leave a trace
+            print(f"Giving up on nickname for {user_id} in {guild_id}: {e!r}")
+
+    async def reconcile(self):
+        """Compare the AFK list with actual nicknames in this shard's guilds and queue fixes."""
+        self.reconciled = True
+        afk_by_guild = {}
+        afk_ids = set()
+        for user_id, entry in storage.get_all_afk():
+            afk_ids.add(user_id)
+            if entry.guild_id is not None:
+                afk_by_guild.setdefault(entry.guild_id, {})[user_id] = entry
+        fixed = 0
+        for guild in list(bot.guilds):
+            try:
+                # AFK users missing the prefix (their edit never happened)
+                entries = afk_by_guild.get(guild.id, {})
+                user_ids = list(entries)
+                for i in range(0, len(user_ids), NICK_QUERY_CHUNK):
+                    chunk = user_ids[i:i + NICK_QUERY_CHUNK]
+                    members = ([m for m in map(guild.get_member, chunk) if m] if guild.chunked else
+                               await guild.query_members(user_ids=chunk, limit=len(chunk), presences=False))
+                    for member in members:
+                        if not member.display_name.startswith(AFK_PREFIX):
+                            self.enqueue(guild.id, member.id, afk_nick(entries[member.id].original_nick or member.name))
+                            fixed += 1
+                # [AFK] nicknames of members who aren't AFK anymore (their restore never happened)
+                members = ([m for m in guild.members if m.nick and m.nick.startswith(AFK_PREFIX)] if guild.chunked else
+                           await guild.query_members(query=AFK_PREFIX, limit=100, presences=False))
+                for member in members:
+                    if member.nick and member.nick.startswith(AFK_PREFIX) and member.id not in afk_ids:
+                        self.enqueue(guild.id, member.id, strip_afk_nick(member.nick))
+                        fixed += 1
+            except (asyncio.TimeoutError, discord.HTTPException, discord.ClientException) as e:
+                print(f"AFK nickname reconciliation failed in {guild.name}: {e}")
+        if fixed:
+            print(f"AFK nickname reconciliation queued {fixed} fixes")
+
+nickname_worker = NicknameWorker()
 
 # ========= Events =========
 @bot.event
 async def on_ready():
-    load_data()
-    save_data_task.start()
+    if not flush_data_task.is_running():
+        flush_data_task.start()
+    delete_scheduler.start()
+    if CLUSTER_WORKER is not None and not cluster_sync_task.is_running():
+        cluster_sync_task.start()
+    if not compact_warnings_task.is_running():
+        compact_warnings_task.start()
+    nickname_worker.start()
+    if not nickname_worker.reconciled:
+        asyncio.create_task(nickname_worker.reconcile())
     print(f'Logged in as {bot.user.name} ({bot.user.id})')
     await bot.change_presence(activity=discord.CustomActivity(name="🔗 dsc.gg/4rea69"))
     print("Bot is online and ready!")
 
+@bot.event
+async def on_member_join(member):
+    if MINIMAL_MEMBER_CACHE:
+        recent_members.remember(member)
+
+@bot.event
+async def on_member_remove(member):
+    recent_members.forget(member.guild.id, member.id)
+
+class MessagePipeline:
+    """Feature stages run for each message.
+
+    Every stage has a cheap prefilter; only matching stages run. Independent stages run
+    concurrently with the chain of "exclusive" stages, which run in registration order
+    until one returns True (handled). Per-stage call counts and timings are kept in `stats`.
+    """
+
+    def __init__(self):
+        self.stages = []  # [(name, prefilter, func, exclusive)]
+        self.stats = {}   # {stage name: {"calls", "errors", "total", "max"}} (seconds)
+
+    def stage(self, prefilter, exclusive: bool = False):
+        def decorator(func):
+            self.stages.append((func.__name__, prefilter, func, exclusive))
+            self.stats[func.__name__] = {"calls": 0, "errors": 0, "total": 0.0, "max": 0.0}
+            return func
+        return decorator
+
+    async def _run_stage(self, name, func, message):
+        stats = self.stats[name]
+        start = time.perf_counter()
+        try:
+            return await func(message)
+        except Exception as e:
+            stats["errors"] += 1
+            print(f"Error in message stage {name}: {e}")
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.observe("area69_message_stage_seconds", elapsed, stage=name)
+            stats["calls"] += 1
+            stats["total"] += elapsed
+            stats["max"] = max(stats["max"], elapsed)
+
+    async def _run_exclusive(self, stages, message):
+        for name, func in stages:
+            if await self._run_stage(name, func, message):
+                break
+
+    async def dispatch(self, message: discord.Message):
+        concurrent, exclusive = [], []
+        for name, prefilter, func, is_exclusive in self.stages:
+            if prefilter(message):
+                (exclusive if is_exclusive else concurrent).append((name, func))
+        runs = [self._run_stage(name, func, message) for name, func in concurrent]
+        if exclusive:
+            runs.append(self._run_exclusive(exclusive, message))
+        if len(runs) == 1:
+            await runs[0]
+        elif runs:
+            # gather starts its tasks in order, so each concurrent stage gets to its first await
+            # (e.g. afk_return clearing AFK) before the exclusive chain sees the message
+            await asyncio.gather(*runs)
+
+pipeline = MessagePipeline()
+
 @bot.event
 async def on_message(message):
     if message.author.bot:
         return
+    await pipeline.dispatch(message)
+
+@pipeline.stage(lambda message: MINIMAL_MEMBER_CACHE and isinstance(message.author, discord.Member))
+async def remember_chatter(message):
+    """Keep recent chatters around when the full member cache is off."""
+    recent_members.remember(message.author)
+
+class AfkNoticeLimiter:
+    """Remembers which AFK users were announced in which channel, so a busy channel
+    pinging the same AFK person gets one notice per AFK_NOTICE_WINDOW."""
+
+    def __init__(self, window: float):
+        self.window = window
+        self._announced = collections.OrderedDict()  # (channel_id, user_id) -> monotonic time, oldest first
+
+    def should_announce(self, channel_id: int, user_id: int) -> bool:
+        now = time.monotonic()
+        while self._announced and next(iter(self._announced.values())) <= now - self.window:
+            self._announced.popitem(last=False)
+        if (channel_id, user_id) in self._announced:
+            return False
+        self._announced[(channel_id, user_id)] = now
+        return True
 
-    # Show AFK reason when mentioning someone AFK
-    for mention in message.mentions:
-        uid = str(mention.id)
-        if uid in afk_users:
-            afk_data = afk_users[uid]
-            await send_temp_message(
-                message.channel,
-                create_embed("⏸️ AFK", f"{mention.display_name} is AFK: {afk_data['reason']}", discord.Color.gold())
-            )
+afk_notices = AfkNoticeLimiter(AFK_NOTICE_WINDOW)
 
-    # Remove AFK when AFK user speaks
-    uid_author = str(message.author.id)
-    if uid_author in afk_users:
-        afk_data = afk_users.pop(uid_author)
-        try:
-            await message.author.edit(nick=afk_data['original_nick'])
-        except:
-            pass
+@pipeline.stage(lambda message: any(storage.is_afk(user.id) for user in message.mentions))
+async def afk_mentions(message):
+    """Show the reason of AFK users that were mentioned: one embed per message, each user
+    at most once per channel per AFK_NOTICE_WINDOW. Every mention is counted."""
+    afk_users = list({user.id: user for user in message.mentions
+                      if user.id != message.author.id and storage.is_afk(user.id)}.values())
+    if not afk_users:
+        return
+    storage.record_afk_mentions([user.id for user in afk_users])
+    lines = []
+    for user in afk_users:
+        if not afk_notices.should_announce(message.channel.id, user.id):
+            continue
+        afk_data = storage.get_afk(user.id)
+        if afk_data:
+            since = f" (since <t:{afk_data.since}:R>)" if afk_data.since else ""
+            lines.append(f"**{user.display_name}** is AFK: {afk_data.reason}{since}")
+    if lines:
+        await send_temp_message(message.channel, create_embed("⏸️ AFK", "\n".join(lines), discord.Color.gold()))
+
+@pipeline.stage(lambda message: storage.is_afk(message.author.id))
+async def afk_return(message):
+    """Remove AFK when AFK user speaks."""
+    afk_data = storage.pop_afk(message.author.id)
+    if afk_data:
+        guild_id = afk_data.guild_id or (message.guild.id if message.guild else None)
+        if guild_id is not None:
+            nickname_worker.enqueue(guild_id, message.author.id, afk_data.original_nick)
+        details = []
+        if afk_data.since:
+            details.append(f"AFK since <t:{afk_data.since}:R>")
+        if afk_data.mentions:
+            details.append(f"{afk_data.mentions} mention{'s' if afk_data.mentions != 1 else ''} while you were away")
+        summary = f"\n{' · '.join(details)}" if details else ""
         await send_temp_message(
             message.channel,
-            create_embed("⏯️ Welcome Back", f"{message.author.mention}, I've removed your AFK status.", discord.Color.green())
-        )
-        save_data()
-
-    # Handle edit ratings
-   
-    if EDIT_CHANNEL_ID and message.channel.id == EDIT_CHANNEL_ID:
-        # ✅ Check for actual video files (not GIFs)
-        has_video_attachment = any(
-            attachment.content_type and attachment.content_type.startswith("video/")
-            for attachment in message.attachments
+            create_embed("⏯️ Welcome Back", f"{message.author.mention}, I've removed your AFK status.{summary}",
+                         discord.Color.green())
         )
 
-        # ✅ Also check for streamable.com links
-        is_streamable = any("streamable.com" in word for word in message.content.split())
+@pipeline.stage(lambda message: message.guild and message.channel.id in guild_settings(message.guild.id).rating_channels)
+async def edit_ratings(message):
+    """Attach rating buttons to video edits posted in the ratings channel."""
+    # ✅ Check for actual video files (not GIFs)
+    has_video_attachment = any(
+        attachment.content_type and attachment.content_type.startswith("video/")
+        for attachment in message.attachments
+    )
 
-        if has_video_attachment or is_streamable:
-            embed = make_rating_embed(message.author, message.id)
-            view = RatingView(message.author, message.id)
-            await message.reply(embed=embed, view=view)
+    # ✅ Also check for streamable.com links
+    is_streamable = any("streamable.com" in word for word in message.content.split())
 
-    await bot.process_commands(message)
+    if has_video_attachment or is_streamable:
+        embed = make_rating_embed(message.author.display_name, message.id)
+        await message.reply(embed=embed, view=rating_view(message.author.id, message.id))
 
 # ========= Error handling (advanced roasts; PERMANENT responses) =========
 @bot.event
 async def on_command_error(ctx, error):
+    if ctx.command is not None:
+        metrics.inc("area69_command_errors_total", command=ctx.command.qualified_name,
+                    error=type(getattr(error, "original", error)).__name__)
     if isinstance(error, commands.CommandNotFound):
         mentioned_users = ctx.message.mentions
         required_perms = ['kick_members', 'ban_members', 'moderate_members', 'manage_messages', 'manage_guild']
@@ -371,6 +2058,9 @@ async def on_command_error(ctx, error):
         # PERMANENT
         await ctx.send(embed=embed)
 
+    elif isinstance(error, RateLimited):
+        await send_slow_down(ctx, ctx.author.id, error.retry_after)
+
     elif isinstance(error, (commands.BadArgument, commands.MissingRequiredArgument)):
         # Staff gets usage (auto-delete), normal users get roast (permanent)
         await show_command_help(ctx)
@@ -396,13 +2086,19 @@ async def help(ctx):
         ("69 help", "Shows this help message"),
         ("69 afk [reason]", "Set yourself as AFK"),
         ("69 warn @user [reason]", "Warn a user (Mod only)"),
+        ("69 warnings @user", "Show a user's active warnings (Mod only)"),
+        ("69 clearwarns @user", "Clear a user's warnings (Mod only)"),
         ("69 kick @user [reason]", "Kick a user (Mod only)"),
         ("69 ban @user [reason]", "Ban a user (Mod only)"),
         ("69 timeout @user 1h [reason]", "Timeout a user (supports s/m/h/d)"),
         ("69 removetimeout @user", "Remove a user's timeout"),
-        ("69 clear [amount] [@user]", "Clear messages (Mod only)"),
+        ("69 massban @users/IDs/joined:10m [reason]", "Ban many users at once (Mod only)"),
+        ("69 masskick @users/IDs/joined:10m [reason]", "Kick many users at once (Mod only)"),
+        ("69 masstimeout 1h @users/IDs/joined:10m [reason]", "Timeout many users at once (Mod only)"),
+        ("69 clear [amount] [@user|bots|attachments|contains:text]", "Clear messages (Mod only)"),
         ("69 setlog #channel", "Set mod log channel (Admin only)"),
-        ("69 set_ratings #channel", "Set edit ratings channel (Admin only)"),
+        ("69 set_ratings #channel", "Add/remove an edit ratings channel (Admin only)"),
+        ("69 settings [key] [value]", "View or change server settings (Admin only)"),
         # Fun
         ("69 joke", "Get a random joke"),
         ("69 rps [rock|paper|scissors]", "Play Rock Paper Scissors"),
@@ -423,19 +2119,19 @@ async def help(ctx):
 @bot.command()
 async def afk(ctx, *, reason: str = "AFK"):
     original_nick = ctx.author.display_name
-    if AFK_PREFIX in original_nick:
+    if AFK_PREFIX in original_nick or storage.is_afk(ctx.author.id):
         await send_temp_message(ctx, create_embed("❌ Error", "You're already AFK!", discord.Color.red()))
         return
 
-    new_nick = f"{AFK_PREFIX} {original_nick}"[:32]
-    try:
-        await ctx.author.edit(nick=new_nick)
-    except discord.Forbidden:
+    # The rename itself happens in the background (nickname_worker), so check up front that it can
+    if ctx.guild and (not ctx.guild.me.guild_permissions.manage_nicknames or ctx.author.id == ctx.guild.owner_id
+                      or ctx.author.top_role >= ctx.guild.me.top_role):
         await send_temp_message(ctx, create_embed("❌ Error", "I don't have permission to change your nickname!", discord.Color.red()))
         return
 
-    afk_users[str(ctx.author.id)] = {'reason': reason, 'original_nick': original_nick}
-    save_data()
+    storage.set_afk(ctx.author.id, reason, original_nick, ctx.guild.id if ctx.guild else None)
+    if ctx.guild:
+        nickname_worker.enqueue(ctx.guild.id, ctx.author.id, afk_nick(original_nick))
 
     await send_temp_message(ctx, create_embed("✅ Success", f"You're now AFK: {reason}", discord.Color.green()))
 
@@ -455,19 +2151,15 @@ async def warn(ctx, member: discord.Member = None, *, reason: str = None):
         await send_temp_message(ctx, create_embed("❌ Error", "You can't warn yourself!", discord.Color.red()))
         return
 
-    gid = str(ctx.guild.id)
-    uid = str(member.id)
-    user_warnings.setdefault(gid, {}).setdefault(uid, [])
-
-    warning = {'moderator': ctx.author.id, 'reason': reason, 'timestamp': datetime.now(TIMEZONE).isoformat()}
-    user_warnings[gid][uid].append(warning)
-    save_data()
+    storage.add_warning(ctx.guild.id, member.id, ctx.author.id, reason, int(time.time()))
 
+    settings = guild_settings(ctx.guild.id)
+    total = storage.count_warnings(ctx.guild.id, member.id, settings.warnings_since())
     timeout_msg = ""
-    if len(user_warnings[gid][uid]) >= MAX_WARNINGS:
+    if total >= settings.max_warnings:
         try:
-            await member.timeout(WARNING_TIMEOUT, reason=f"Reached {MAX_WARNINGS} warnings")
-            timeout_msg = f" User has been timed out for {WARNING_TIMEOUT}."
+            await member.timeout(settings.warning_timeout, reason=f"Reached {settings.max_warnings} warnings")
+            timeout_msg = f" User has been timed out for {settings.warning_timeout}."
         except discord.Forbidden:
             timeout_msg = " Failed to apply timeout (missing permissions)."
 
@@ -476,11 +2168,47 @@ async def warn(ctx, member: discord.Member = None, *, reason: str = None):
         create_embed(
             "✅ Success",
             f"{member.mention} has been warned by {ctx.author.mention} for: {reason}\n"
-            f"Total warnings: {len(user_warnings[gid][uid])}.{timeout_msg}",
+            f"Active warnings: {total}.{timeout_msg}",
             discord.Color.green()
         )
     )
-    await log_action(ctx.guild, "Warn", ctx.author, member, reason)
+    log_action(ctx.guild, "Warn", ctx.author, member, reason)
+
+@bot.command(name="warnings")
+@commands.has_permissions(kick_members=True)
+async def warnings_command(ctx, member: discord.Member = None):
+    if member is None:
+        await show_command_help(ctx)
+        return
+
+    settings = guild_settings(ctx.guild.id)
+    active = storage.get_warnings(ctx.guild.id, member.id, settings.warnings_since())
+    if not active:
+        await send_temp_message(ctx, create_embed("📋 Warnings", f"{member.mention} has no active warnings.", discord.Color.green()))
+        return
+
+    lines = []
+    for warning in active[-10:]:
+        lines.append(f"<t:{warning.timestamp}:R> by <@{warning.moderator_id}>: {warning.reason}")
+    expiry = f"expire after {settings.warning_expiry}" if settings.warning_expiry else "never expire"
+    embed = create_embed(
+        "📋 Warnings",
+        f"{member.mention} has **{len(active)}** active warning{'s' if len(active) != 1 else ''} "
+        f"(warnings {expiry}).\n\n" + "\n".join(lines),
+        discord.Color.orange()
+    )
+    await send_temp_message(ctx, embed)
+
+@bot.command()
+@commands.has_permissions(kick_members=True)
+async def clearwarns(ctx, member: discord.Member = None):
+    if member is None:
+        await show_command_help(ctx)
+        return
+
+    removed = storage.clear_warnings(ctx.guild.id, member.id)
+    await send_temp_message(ctx, create_embed("✅ Success", f"Cleared {removed} warning{'s' if removed != 1 else ''} for {member.mention}.", discord.Color.green()))
+    log_action(ctx.guild, "Clear Warnings", ctx.author, member, f"{removed} warnings removed")
 
 @bot.command()
 @commands.has_permissions(kick_members=True)
@@ -500,7 +2228,7 @@ async def kick(ctx, member: discord.Member = None, *, reason: str = None):
     try:
         await member.kick(reason=reason)
         await send_temp_message(ctx, create_embed("✅ Success", f"{member.mention} has been kicked by {ctx.author.mention} for: {reason}", discord.Color.green()))
-        await log_action(ctx.guild, "Kick", ctx.author, member, reason)
+        log_action(ctx.guild, "Kick", ctx.author, member, reason)
     except discord.Forbidden:
         await send_temp_message(ctx, create_embed("❌ Error", "I don't have permission to kick this user!", discord.Color.red()))
 
@@ -522,7 +2250,7 @@ async def ban(ctx, member: discord.Member = None, *, reason: str = None):
     try:
         await member.ban(reason=reason)
         await send_temp_message(ctx, create_embed("✅ Success", f"{member.mention} has been banned by {ctx.author.mention} for: {reason}", discord.Color.green()))
-        await log_action(ctx.guild, "Ban", ctx.author, member, reason)
+        log_action(ctx.guild, "Ban", ctx.author, member, reason)
     except discord.Forbidden:
         await send_temp_message(ctx, create_embed("❌ Error", "I don't have permission to ban this user!", discord.Color.red()))
 
@@ -542,37 +2270,15 @@ async def timeout(ctx, member: discord.Member = None, duration: str = None, *, r
         return
 
     try:
-        num_str = ''
-        for ch in duration:
-            if ch.isdigit():
-                num_str += ch
-            else:
-                break
-        value = int(num_str)
-        unit = duration[len(num_str):].lower()
-
-        if unit in ['s', 'sec', 'second', 'seconds']:
-            delta = timedelta(seconds=value)
-            unit_display = f"{value} second{'s' if value != 1 else ''}"
-        elif unit in ['m', 'min', 'minute', 'minutes']:
-            delta = timedelta(minutes=value)
-            unit_display = f"{value} minute{'s' if value != 1 else ''}"
-        elif unit in ['h', 'hour', 'hours']:
-            delta = timedelta(hours=value)
-            unit_display = f"{value} hour{'s' if value != 1 else ''}"
-        elif unit in ['d', 'day', 'days']:
-            delta = timedelta(days=value)
-            unit_display = f"{value} day{'s' if value != 1 else ''}"
-        else:
-            raise ValueError
-    except (ValueError, IndexError):
+        delta, unit_display = parse_duration(duration)
+    except ValueError:
         await send_temp_message(ctx, create_embed("❌ Error", "Invalid duration! Use like '30s', '5min', '1hour', '7days'", discord.Color.red()))
         return
 
     try:
         await member.timeout(delta, reason=reason)
         await send_temp_message(ctx, create_embed("✅ Success", f"{member.mention} timed out by {ctx.author.mention} for {unit_display} — Reason: {reason}", discord.Color.green()))
-        await log_action(ctx.guild, "Timeout", ctx.author, member, reason)
+        log_action(ctx.guild, "Timeout", ctx.author, member, reason)
     except discord.Forbidden:
         await send_temp_message(ctx, create_embed("❌ Error", "I don't have permission to timeout this user!", discord.Color.red()))
 
@@ -590,32 +2296,248 @@ async def removetimeout(ctx, member: discord.Member = None):
     try:
         await member.timeout(None)
         await send_temp_message(ctx, create_embed("✅ Success", f"{member.mention}'s timeout has been removed by {ctx.author.mention}.", discord.Color.green()))
-        await log_action(ctx.guild, "Remove Timeout", ctx.author, member, None)
+        log_action(ctx.guild, "Remove Timeout", ctx.author, member, None)
     except discord.Forbidden:
         await send_temp_message(ctx, create_embed("❌ Error", "I don't have permission to remove this user's timeout!", discord.Color.red()))
 
-@bot.command(aliases=['purge'])
+# ----- Raid mode (bulk moderation) -----
+MASS_ACTION_MAX_TARGETS = 200  # also Discord's bulk ban limit per request
+MASS_ACTION_CONCURRENCY = 5    # member edits in flight at once; discord.py queues per rate-limit bucket
+MASS_TARGET_RE = re.compile(r"<@!?([0-9]{15,20})>|([0-9]{15,20})")
+
+def mass_target_allowed(ctx, member: discord.Member) -> bool:
+    """False for bots and anyone at/above the invoker's top role (the owner may target anyone)."""
+    return not (member.bot or (ctx.author.id != ctx.guild.owner_id and member.top_role >= ctx.author.top_role))
+
+async def parse_mass_targets(ctx, args) -> tuple:
+    """Split command args into (target IDs, reason).
+
+    Leading args are mentions, raw IDs or a `joined:<duration>` selector (members who
+    joined within that window); everything after them is the reason. Raises ValueError
+    on a bad selector duration. IDs that aren't cached are fetched so the same checks
+    apply to them; IDs that aren't members at all are kept (they can still be banned).
+    """
+    ids = []
+    i = 0
+    while i < len(args):
+        match = MASS_TARGET_RE.fullmatch(args[i])
+        if match:
+            ids.append(int(match[1] or match[2]))
+        elif args[i].lower().startswith("joined:"):
+            cutoff = discord.utils.utcnow() - parse_duration(args[i][len("joined:"):])[0]
+            ids.extend(m.id for m in members_joined_since(ctx.guild, cutoff))
+        else:
+            break
+        i += 1
+    reason = " ".join(args[i:]) or None
+
+    # Never act on the invoker, the bot, the owner or anyone at/above the invoker's top role
+    skipped = {ctx.author.id, ctx.guild.me.id, ctx.guild.owner_id}
+    candidates = [user_id for user_id in dict.fromkeys(ids) if user_id not in skipped][:MASS_ACTION_MAX_TARGETS]
+    slots = asyncio.Semaphore(MASS_ACTION_CONCURRENCY)
+
+    async def allowed(user_id) -> bool:
+        member = find_member(ctx.guild, user_id)
+        if member is None:
+            async with slots:
+                try:
+                    member = await ctx.guild.fetch_member(user_id)
+                except discord.NotFound:
+                    return True  # not a member: nothing to outrank
+                except discord.HTTPException:
+                    return False  # can't check the hierarchy, so leave them alone
+            recent_members.remember(member)  # run_mass_member_action needn't fetch them again
+        return mass_target_allowed(ctx, member)
+
+    checks = await asyncio.gather(*(allowed(user_id) for user_id in candidates))
+    return [user_id for user_id, ok in zip(candidates, checks) if ok], reason
+
+async def run_mass_member_action(ctx, targets: list, action) -> tuple:
+    """Await action(member) for every target with bounded concurrency; return (done, failed) ID lists."""
+    slots = asyncio.Semaphore(MASS_ACTION_CONCURRENCY)
+    done, failed = [], []
+
+    async def run(user_id):
+        async with slots:
+            try:
+                member = find_member(ctx.guild, user_id) or await ctx.guild.fetch_member(user_id)
+                if not mass_target_allowed(ctx, member):
+                    return  # roles changed since the targets were checked
+                await action(member)
+                done.append(user_id)
+            except discord.HTTPException:
+                failed.append(user_id)
+
+    await asyncio.gather(*(run(user_id) for user_id in targets))
+    return done, failed
+
+async def report_mass_action(ctx, log_name: str, summary: str, done: list, failed: list, reason: Optional[str]):
+    """One summary reply and one aggregated mod-log entry for a bulk action."""
+    description = f"{summary}: **{len(done)}** user{'s' if len(done) != 1 else ''} by {ctx.author.mention}."
+    if failed:
+        shown = ", ".join(f"<@{uid}>" for uid in failed[:20])
+        description += f"\nFailed for {len(failed)}: {shown}{' …' if len(failed) > 20 else ''}"
+    color = discord.Color.green() if done else discord.Color.red()
+    await send_temp_message(ctx, create_embed("✅ Raid Action" if done else "❌ Raid Action", description, color))
+    if done:
+        shown = ", ".join(str(uid) for uid in done[:40])
+        log_action(ctx.guild, log_name, ctx.author,
+                   f"{len(done)} users: {shown}{' …' if len(done) > 40 else ''}", reason)
+
+@bot.command(usage="@user1 @user2 joined:10m raid")
+@commands.has_permissions(ban_members=True)
+async def massban(ctx, *args):
+    try:
+        targets, reason = await parse_mass_targets(ctx, args)
+    except ValueError:
+        targets = None
+    if not targets:
+        await show_command_help(ctx)
+        return
+
+    try:
+        # One API call per 200 users instead of one per user
+        result = await ctx.guild.bulk_ban([discord.Object(id=uid) for uid in targets], reason=reason,
+                                          delete_message_seconds=0)
+        done, failed = [u.id for u in result.banned], [u.id for u in result.failed]
+    except discord.Forbidden:
+        await send_temp_message(ctx, create_embed("❌ Error", "I don't have permission to ban these users!", discord.Color.red()))
+        return
+    except discord.HTTPException:
+        done, failed = [], targets  # Discord rejects the whole request when no one could be banned
+    await report_mass_action(ctx, "Mass Ban", "Banned", done, failed, reason)
+
+@bot.command(usage="@user1 @user2 joined:10m raid")
+@commands.has_permissions(kick_members=True)
+async def masskick(ctx, *args):
+    try:
+        targets, reason = await parse_mass_targets(ctx, args)
+    except ValueError:
+        targets = None
+    if not targets:
+        await show_command_help(ctx)
+        return
+
+    done, failed = await run_mass_member_action(ctx, targets, lambda member: member.kick(reason=reason))
+    await report_mass_action(ctx, "Mass Kick", "Kicked", done, failed, reason)
+
+@bot.command(usage="1h @user1 @user2 joined:10m raid")
+@commands.has_permissions(moderate_members=True)
+async def masstimeout(ctx, duration: str = None, *args):
+    try:
+        delta, unit_display = parse_duration(duration or "")
+        targets, reason = await parse_mass_targets(ctx, args)
+    except ValueError:
+        targets = None
+    if not targets:
+        await show_command_help(ctx)
+        return
+
+    done, failed = await run_mass_member_action(ctx, targets, lambda member: member.timeout(delta, reason=reason))
+    await report_mass_action(ctx, "Mass Timeout", f"Timed out for {unit_display}", done, failed, reason)
+
+# ----- Purge -----
+PURGE_MAX_AMOUNT = 1000    # messages deleted at most per run
+PURGE_SCAN_LIMIT = 5000    # messages scanned at most per run
+PURGE_PROGRESS_EVERY = 25  # single deletions between progress updates
+BULK_DELETE_MAX_AGE = timedelta(days=14) - timedelta(minutes=5)  # Discord's bulk delete window, with a margin
+
+async def parse_purge_filters(ctx, args):
+    """Turn clear's filter args into (check, description). Raises commands.BadArgument.
+
+    Filters: @user / ID, `bots`, `attachments`, `contains:<text>` (the rest of the line).
+    """
+    checks, parts = [], []
+    for i, arg in enumerate(args):
+        lowered = arg.lower()
+        if lowered in ("bots", "bot"):
+            checks.append(lambda m: m.author.bot)
+            parts.append("from bots")
+        elif lowered in ("attachments", "files", "images"):
+            checks.append(lambda m: bool(m.attachments))
+            parts.append("with attachments")
+        elif lowered.startswith("contains:"):
+            text = " ".join([arg[len("contains:"):], *args[i + 1:]]).strip().lower()
+            if not text:
+                raise commands.BadArgument("contains: needs some text")
+            checks.append(lambda m, text=text: text in m.content.lower())
+            parts.append(f"containing \"{text}\"")
+            break
+        else:
+            # Mentions and IDs are taken as-is so users who already left (or were banned) still match
+            match = MASS_TARGET_RE.fullmatch(arg)
+            user_id = int(match[1] or match[2]) if match else (await commands.MemberConverter().convert(ctx, arg)).id
+            checks.append(lambda m, user_id=user_id: m.author.id == user_id)
+            parts.append(f"from <@{user_id}>")
+    return (lambda m: all(check(m) for check in checks)), " ".join(parts) or "in this channel"
+
+@bot.command(aliases=['purge'], usage="50 @user")
 @commands.has_permissions(manage_messages=True)
-async def clear(ctx, amount: int = None, member: discord.Member = None):
+async def clear(ctx, amount: int = None, *filters):
     if amount is None:
         await show_command_help(ctx)
         return
-    if amount < 1 or amount > 100:
-        await send_temp_message(ctx, create_embed("❌ Error", "Amount must be between 1 and 100.", discord.Color.red()))
+    if amount < 1 or amount > PURGE_MAX_AMOUNT:
+        await send_temp_message(ctx, create_embed("❌ Error", f"Amount must be between 1 and {PURGE_MAX_AMOUNT}.", discord.Color.red()))
         return
-
-    def check(m):
-        if member:
-            return m.author == member
-        return True
+    check, target_desc = await parse_purge_filters(ctx, filters)
+
+    # Stream history page by page until enough matches (or the scan ceiling). Recent matches
+    # go out in bulk deletes of 100; ones older than 14 days can only be deleted one by one.
+    bulk_cutoff = discord.utils.utcnow() - BULK_DELETE_MAX_AGE
+    batch, old = [], []
+    deleted = scanned = 0
+    progress = None
+
+    async def report_progress():
+        nonlocal progress
+        text = f"Deleted {deleted}/{amount} messages {target_desc} (scanned {scanned})…"
+        if progress is None:
+            progress = await ctx.send(embed=create_embed("🧹 Purging", text, discord.Color.blue()))
+        else:
+            await progress.edit(embed=create_embed("🧹 Purging", text, discord.Color.blue()))
 
     try:
-        deleted = await ctx.channel.purge(limit=amount + 1, check=check)
-        await send_temp_message(ctx, create_embed("✅ Success", f"Deleted {len(deleted) - 1} messages {'from ' + member.mention if member else ''}.", discord.Color.green()))
-        target_desc = f"from {member.mention}" if member else "in this channel"
-        await log_action(ctx.guild, "Clear", ctx.author, ctx.channel, f"{len(deleted) - 1} messages {target_desc}")
+        try:
+            await ctx.message.delete()
+        except discord.NotFound:
+            pass
+        async for message in ctx.channel.history(limit=PURGE_SCAN_LIMIT, before=ctx.message):
+            scanned += 1
+            if message.id == getattr(progress, "id", None) or not check(message):
+                continue
+            (batch if message.created_at > bulk_cutoff else old).append(message)
+            if len(batch) == 100:
+                await ctx.channel.delete_messages(batch)
+                deleted += len(batch)
+                batch = []
+                await report_progress()
+            if deleted + len(batch) + len(old) >= amount:
+                break
+        if batch:
+            await ctx.channel.delete_messages(batch)
+            deleted += len(batch)
+        for i, message in enumerate(old, 1):
+            try:
+                await message.delete()
+                deleted += 1
+            except discord.NotFound:
+                pass
+            if i % PURGE_PROGRESS_EVERY == 0:
+                await report_progress()
     except discord.Forbidden:
         await send_temp_message(ctx, create_embed("❌ Error", "I don't have permission to delete messages here!", discord.Color.red()))
+        return
+    finally:
+        if progress is not None:
+            try:
+                await progress.delete()
+            except discord.HTTPException:
+                pass
+
+    note = f" (stopped after scanning {scanned} messages)" if deleted < amount and scanned >= PURGE_SCAN_LIMIT else ""
+    await send_temp_message(ctx, create_embed("✅ Success", f"Deleted {deleted} messages {target_desc}.{note}", discord.Color.green()))
+    log_action(ctx.guild, "Clear", ctx.author, ctx.channel, f"{deleted} messages {target_desc}")
 
 @bot.command()
 @commands.has_permissions(manage_guild=True)
@@ -623,26 +2545,147 @@ async def setlog(ctx, channel: discord.TextChannel = None):
     if channel is None:
         await show_command_help(ctx)
         return
-    mod_log_channels[str(ctx.guild.id)] = channel.id
-    save_data()
+    settings = guild_settings(ctx.guild.id)
+    settings.mod_log_channel = channel.id
+    settings.save()
     await send_temp_message(ctx, create_embed("✅ Success", f"Mod logs will now be sent to {channel.mention}.", discord.Color.green()))
-    await log_action(ctx.guild, "Log Channel Set", ctx.author, channel, None)
+    log_action(ctx.guild, "Log Channel Set", ctx.author, channel, None)
 
 # ----- Rating System -----
 @bot.command(name="set_ratings")
 @commands.has_permissions(manage_guild=True)
 async def set_ratings(ctx, channel: Optional[discord.TextChannel] = None):
-    global EDIT_CHANNEL_ID
+    settings = guild_settings(ctx.guild.id)
     if channel is None:
-        EDIT_CHANNEL_ID = None
-        config["edit_channel_id"] = None
-        save_data()
-        await ctx.send("❌ Ratings channel removed. The feature is now disabled.")
+        settings.rating_channels.clear()
+        settings.save()
+        await ctx.send("❌ Ratings channels removed. The feature is now disabled.")
+    elif channel.id in settings.rating_channels:
+        settings.rating_channels.discard(channel.id)
+        settings.save()
+        await ctx.send(f"❌ {channel.mention} is no longer a ratings channel.")
     else:
-        EDIT_CHANNEL_ID = channel.id
-        config["edit_channel_id"] = EDIT_CHANNEL_ID
-        save_data()
-        await ctx.send(f"✅ Ratings channel set to {channel.mention}")
+        settings.rating_channels.add(channel.id)
+        settings.save()
+        await ctx.send(f"✅ {channel.mention} added as a ratings channel.")
+
+# ----- Server settings -----
+@bot.command()
+@commands.has_permissions(manage_guild=True)
+async def settings(ctx, key: str = None, value: str = None):
+    settings = guild_settings(ctx.guild.id)
+    if key is None:
+        rating_channels = ", ".join(f"<#{cid}>" for cid in settings.rating_channels) or "None"
+        await send_temp_message(ctx, create_embed(
+            "⚙️ Server Settings",
+            f"**Ratings channels:** {rating_channels}\n"
+            f"**Mod log channel:** {f'<#{settings.mod_log_channel}>' if settings.mod_log_channel else 'None'}\n"
+            f"**max_warnings:** {settings.max_warnings}\n"
+            f"**warning_timeout:** {settings.warning_timeout}\n"
+            f"**delete_delay:** {settings.delete_delay}s\n"
+            f"**warning_expiry:** {settings.warning_expiry or 'never'}",
+            discord.Color.blue()
+        ))
+        return
+    if value is None:
+        await show_command_help(ctx)
+        return
+
+    try:
+        key = key.lower()
+        if key == "max_warnings":
+            settings.max_warnings = max(1, int(value))
+        elif key == "warning_timeout":
+            settings.warning_timeout = parse_duration(value)[0]
+        elif key == "delete_delay":
+            seconds = int(value) if value.isdigit() else int(parse_duration(value)[0].total_seconds())
+            settings.delete_delay = max(1, seconds)
+        elif key == "warning_expiry":
+            settings.warning_expiry = timedelta(0) if value.lower() in ("0", "never") else parse_duration(value)[0]
+        else:
+            await send_temp_message(ctx, create_embed(
+                "❌ Error", "Unknown setting! Use `max_warnings`, `warning_timeout`, `warning_expiry` or `delete_delay`.", discord.Color.red()))
+            return
+    except ValueError:
+        await send_temp_message(ctx, create_embed("❌ Error", f"Invalid value for `{key}`!", discord.Color.red()))
+        return
+    settings.save()
+    await send_temp_message(ctx, create_embed("✅ Success", f"`{key}` set to **{value}**.", discord.Color.green()))
+
+@bot.command(aliases=['memory'])
+@commands.is_owner()
+async def shards(ctx):
+    """Owner-only: per-shard latency and cache sizes, plus process memory."""
+    latencies = dict(getattr(bot, "latencies", None) or [(0, bot.latency)])
+    per_shard = collections.defaultdict(lambda: [0, 0, 0, 0])  # guilds, channels, cached members, recent members
+    for guild in bot.guilds:
+        counts = per_shard[guild.shard_id or 0]
+        counts[0] += 1
+        counts[1] += len(guild.channels)
+        counts[2] += len(guild.members)
+        counts[3] += len(recent_members.in_guild(guild.id))
+    lines = []
+    for shard_id in sorted(set(latencies) | set(per_shard)):
+        guilds, channels, members, recent = per_shard[shard_id]
+        latency = latencies.get(shard_id, float("nan")) * 1000
+        lines.append(f"**Shard {shard_id}:** {latency:.0f}ms · {guilds} guilds · {channels} channels · "
+                     f"{members} cached members · {recent} recent")
+    lines.append(f"\n**Process:** {process_rss_mb():.1f} MiB RSS · {len(bot.users)} users · "
+                 f"{len(bot.cached_messages)} messages · member cache `{MEMBER_CACHE}`")
+    await send_temp_message(ctx, create_embed("🧩 Shards", "\n".join(lines), discord.Color.blue()))
+
+@bot.command(name='stats')
+@commands.is_owner()
+async def stats_command(ctx):
+    """Owner-only: loop lag, slowest stages/commands, Discord API and chatbot numbers."""
+    def ms(seconds):
+        return f"{seconds * 1000:.1f}ms" if seconds != float("inf") else ">30s"
+
+    embed = create_embed("📊 Stats", f"Loop lag now {ms(loop_monitor.lag)}, max {ms(loop_monitor.max_lag)} "
+                         f"(last {len(loop_monitor.samples)} samples) · {process_rss_mb():.1f} MiB RSS",
+                         discord.Color.blue())
+    stages = sorted(pipeline.stats.items(), key=lambda item: item[1]["total"], reverse=True)
+    embed.add_field(name="Message stages", inline=False, value="\n".join(
+        f"`{name}` {s['calls']} calls · avg {ms(s['total'] / s['calls'])} · max {ms(s['max'])}"
+        + (f" · {s['errors']} errors" if s['errors'] else "")
+        for name, s in stages if s["calls"]) or "No messages yet")
+    store = conversations.stats()
+    conversation_line = (f"{store['conversations']} conversations · {store['chars']:,} chars · "
+                         f"{store['hits']} hits / {store['misses']} misses · {store['evictions']} evicted · "
+                         f"{store['expirations']} expired · {store['trimmed_messages']} messages trimmed")
+    if not metrics.enabled:
+        embed.add_field(name="Chatbot", inline=False, value=conversation_line)
+        embed.add_field(name="Metrics", value="Disabled: set `METRICS=1` for commands, API and chatbot stats.")
+        await send_temp_message(ctx, embed)
+        return
+
+    commands_rows = metrics.summary("area69_command_seconds")[:8]
+    embed.add_field(name="Commands", inline=False, value="\n".join(
+        f"`{labels['command']}` {count} · avg {ms(mean)} · p99 ≤{ms(p99)}"
+        for labels, count, mean, p99 in commands_rows) or "None yet")
+    api = metrics.summary("area69_discord_api_seconds")
+    api_calls = sum(row[1] for row in api)
+    api_mean = sum(row[1] * row[2] for row in api) / api_calls if api_calls else 0
+    slowest = max(api, key=lambda row: row[2], default=None)
+    embed.add_field(name="Discord API", inline=False, value=(
+        f"{api_calls} calls · avg {ms(api_mean)} · "
+        f"{metrics.counter('area69_discord_rate_limited_total', kind='429'):.0f} 429s · "
+        f"{metrics.counter('area69_discord_api_errors_total'):.0f} errors"
+        + (f"\nSlowest: `{slowest[0]['method']} {slowest[0]['route']}` avg {ms(slowest[2])}" if slowest else "")))
+    chat = metrics.summary("area69_chat_seconds")
+    chat_calls = sum(row[1] for row in chat)
+    embed.add_field(name="Chatbot", inline=False, value=(
+        f"{chat_calls} replies · avg "
+        f"{ms(sum(row[1] * row[2] for row in chat) / chat_calls if chat_calls else 0)} · "
+        f"{metrics.counter('area69_chat_tokens_total', kind='prompt'):.0f} prompt / "
+        f"{metrics.counter('area69_chat_tokens_total', kind='completion'):.0f} completion tokens · "
+        f"{metrics.counter('area69_chat_errors_total'):.0f} errors\n{conversation_line}"))
+    flushes = metrics.summary("area69_storage_flush_seconds")
+    if flushes:
+        labels, count, mean, p99 = flushes[0]
+        embed.add_field(name="Storage", inline=False,
+                        value=f"{labels['backend']}: {count} flushes · avg {ms(mean)} · p99 ≤{ms(p99)}")
+    await send_temp_message(ctx, embed)
 
 # ========= FUN COMMANDS (now work everywhere) =========
 @bot.command()
@@ -715,11 +2758,9 @@ async def compliment(ctx, member: discord.Member = None):
 @bot.command()
 async def cat(ctx):
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get('https://api.thecatapi.com/v1/images/search') as response:
-                data = await response.json()
+        url = await image_buffers["cat"].get()
         embed = create_embed("🐱 Cat", "Here's a cat!", discord.Color.random())
-        embed.set_image(url=data[0]['url'])
+        embed.set_image(url=url)
         await ctx.send(embed=embed)
     except:
         await ctx.send(embed=create_embed("❌ Error", "Couldn't fetch a cat!", discord.Color.red()))
@@ -727,11 +2768,9 @@ async def cat(ctx):
 @bot.command()
 async def dog(ctx):
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get('https://dog.ceo/api/breeds/image/random') as response:
-                data = await response.json()
+        url = await image_buffers["dog"].get()
         embed = create_embed("🐶 Dog", "Here's a dog!", discord.Color.random())
-        embed.set_image(url=data['message'])
+        embed.set_image(url=url)
         await ctx.send(embed=embed)
     except:
         await ctx.send(embed=create_embed("❌ Error", "Couldn't fetch a dog!", discord.Color.red()))
@@ -746,14 +2785,21 @@ async def avatar(ctx, member: discord.Member = None):
     await ctx.send(embed=embed)
        # chat bot
 
-# Groq client setup
+# Groq client setup (async client so completions never block the event loop;
+# GROQ_BASE_URL is honoured by the client for pointing at another endpoint)
 GROQ_API_KEY = os.getenv('GROQ_API_KEY')
+CHAT_REQUEST_TIMEOUT = float(os.getenv('CHAT_REQUEST_TIMEOUT', 30))  # seconds per completion
 if GROQ_API_KEY:
-    groq_client = groq.Groq(api_key=GROQ_API_KEY)
+    groq_client = groq.AsyncGroq(api_key=GROQ_API_KEY, timeout=CHAT_REQUEST_TIMEOUT, max_retries=1)
 else:
     print("Warning: GROQ_API_KEY not found. Chatbot functionality will be disabled.")
     groq_client = None
 
+# Streaming: replies appear as the completion streams in, edited at most once per interval
+CHAT_STREAMING = os.getenv('CHAT_STREAMING', '1') == '1'
+CHAT_STREAM_EDIT_INTERVAL = float(os.getenv('CHAT_STREAM_EDIT_INTERVAL', 1.0))  # seconds between edits
+DISCORD_MESSAGE_LIMIT = 2000
+
 # Server owner ID
 SERVER_OWNER_ID = "1231918634088009748"
 
@@ -773,17 +2819,141 @@ If someone says "touch him," "fuck him," "slap him," "kiss him," or anything lik
 
 If someone asks what you do, keep it real: you're here for games, moderation, roasting, chill chats, NSFW banter, and anything else the crew wants. No restrictions unless the server owner says otherwise."""
 
-# Conversation history storage (limited to avoid memory issues)
-conversation_histories = {}
-
-def cleanup_old_conversations():
-    """Remove old conversation histories to prevent memory issues"""
-    global conversation_histories
-    current_time = time.time()
-    # Remove conversations older than 1 hour
-    for user_id in list(conversation_histories.keys()):
-        if current_time - conversation_histories[user_id]['last_activity'] > 3600:
-            del conversation_histories[user_id]
+# Concurrency limits for completions: requests beyond the caps wait up to
+# CHAT_QUEUE_TIMEOUT seconds for a slot, then get CHAT_BUSY_REPLY instead of piling up.
+CHAT_MAX_INFLIGHT = int(os.getenv('CHAT_MAX_INFLIGHT', 8))
+CHAT_MAX_INFLIGHT_PER_GUILD = int(os.getenv('CHAT_MAX_INFLIGHT_PER_GUILD', 3))
+CHAT_QUEUE_TIMEOUT = float(os.getenv('CHAT_QUEUE_TIMEOUT', 10))
+CHAT_BUSY_REPLY = "I'm juggling too many conversations right now. Try again in a moment!"
+
+chat_slots = None        # global semaphore, created lazily on the running loop
+chat_guild_slots = {}    # {guild_id: semaphore}
+
+class ChatBusy(Exception):
+    """Raised when no completion slot frees up within CHAT_QUEUE_TIMEOUT."""
+
+@contextlib.asynccontextmanager
+async def chat_slot(guild_id):
+    """Hold one per-guild and one global completion slot for the duration of the block."""
+    global chat_slots
+    if chat_slots is None:
+        chat_slots = asyncio.Semaphore(CHAT_MAX_INFLIGHT)
+    guild_slots = chat_guild_slots.get(guild_id)
+    if guild_slots is None:
+        guild_slots = chat_guild_slots[guild_id] = asyncio.Semaphore(CHAT_MAX_INFLIGHT_PER_GUILD)
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + CHAT_QUEUE_TIMEOUT
+    try:
+        await asyncio.wait_for(guild_slots.acquire(), CHAT_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise ChatBusy()
+    try:
+        try:
+            await asyncio.wait_for(chat_slots.acquire(), max(0, deadline - loop.time()))
+        except asyncio.TimeoutError:
+            raise ChatBusy()
+        try:
+            yield
+        finally:
+            chat_slots.release()
+    finally:
+        guild_slots.release()
+
+# Conversation history storage (bounded: entry cap, idle TTL and a character budget per conversation)
+CHAT_MAX_CONVERSATIONS = int(os.getenv('CHAT_MAX_CONVERSATIONS', 1000))
+CHAT_CONVERSATION_TTL = int(os.getenv('CHAT_CONVERSATION_TTL', 3600))        # seconds of inactivity
+CHAT_HISTORY_CHAR_BUDGET = int(os.getenv('CHAT_HISTORY_CHAR_BUDGET', 6000))  # chars kept besides the system prompt
+
+class ConversationStore:
+    """Chat histories keyed by (user_id, guild_id).
+
+    The OrderedDict is kept in least-recently-used order, which is also last-activity
+    order, so LRU eviction and TTL expiry only ever look at the front of it.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, char_budget: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.char_budget = char_budget
+        self._entries = collections.OrderedDict()
+        self.hits = self.misses = self.evictions = self.expirations = self.trimmed = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, user_id: int, guild_id: int, temperature: float) -> dict:
+        """Return the conversation for this member, creating it if needed."""
+        self.expire()
+        key = (user_id, guild_id)
+        conversation = self._entries.get(key)
+        if conversation is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        else:
+            self.misses += 1
+            conversation = self._entries[key] = {
+                'messages': [{"role": "system", "content": CHATBOT_SYSTEM_PROMPT}],
+                'chars': 0,
+                'temperature': temperature,
+            }
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        conversation['last_activity'] = time.time()
+        return conversation
+
+    def append(self, conversation: dict, role: str, content: str):
+        """Add a message, dropping the oldest ones once the character budget is exceeded."""
+        conversation['messages'].append({"role": role, "content": content})
+        conversation['chars'] += len(content)
+        messages = conversation['messages']
+        while conversation['chars'] > self.char_budget and len(messages) > 2:  # keep system prompt + newest
+            conversation['chars'] -= len(messages.pop(1)['content'])
+            self.trimmed += 1
+
+    def expire(self):
+        cutoff = time.time() - self.ttl
+        while self._entries:
+            conversation = next(iter(self._entries.values()))
+            if conversation['last_activity'] >= cutoff:
+                break
+            self._entries.popitem(last=False)
+            self.expirations += 1
+
+    def stats(self) -> dict:
+        return {
+            'conversations': len(self._entries),
+            'chars': sum(c['chars'] for c in self._entries.values()),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'trimmed_messages': self.trimmed,
+        }
+
+conversations = ConversationStore(CHAT_MAX_CONVERSATIONS, CHAT_CONVERSATION_TTL, CHAT_HISTORY_CHAR_BUDGET)
+
+metrics.describe("area69_chat_conversations", "gauge", "Chatbot conversations held in memory")
+metrics.describe("area69_chat_history_chars", "gauge", "Characters of chat history held in memory")
+metrics.describe("area69_chat_conversation_hits_total", "counter", "Chatbot messages that continued a stored conversation")
+metrics.describe("area69_chat_conversation_misses_total", "counter", "Chatbot messages that started a new conversation")
+metrics.describe("area69_chat_conversation_evictions_total", "counter", "Conversations dropped for CHAT_MAX_CONVERSATIONS")
+metrics.describe("area69_chat_conversation_expirations_total", "counter", "Conversations dropped after CHAT_CONVERSATION_TTL")
+metrics.describe("area69_chat_trimmed_messages_total", "counter", "History messages dropped for CHAT_HISTORY_CHAR_BUDGET")
+
+@metrics.collect
+def conversation_metrics():
+    stats = conversations.stats()
+    return [
+        ("area69_chat_conversations", "gauge", stats['conversations']),
+        ("area69_chat_history_chars", "gauge", stats['chars']),
+        ("area69_chat_conversation_hits_total", "counter", stats['hits']),
+        ("area69_chat_conversation_misses_total", "counter", stats['misses']),
+        ("area69_chat_conversation_evictions_total", "counter", stats['evictions']),
+        ("area69_chat_conversation_expirations_total", "counter", stats['expirations']),
+        ("area69_chat_trimmed_messages_total", "counter", stats['trimmed_messages']),
+    ]
 
 def replace_mentions_with_ids(message_content, message):
     """Replace @username mentions with actual user IDs for proper mentioning"""
@@ -794,172 +2964,366 @@ def replace_mentions_with_ids(message_content, message):
     
     return message_content
 
-async def generate_chat_response(user_message, user_id, guild_id, is_owner=False):
-    """Generate a response using Groq API"""
+async def generate_chat_response(user_message, user_id, guild_id, is_owner=False, on_delta=None):
+    """Generate a response using Groq API.
+
+    With on_delta the completion is streamed and each text delta is awaited through it.
+    """
     if not groq_client:
         return "Chatbot functionality is currently unavailable. Please check my configuration."
     
     try:
-        # Get or create conversation history
-        conversation_key = f"{user_id}_{guild_id}"
-        if conversation_key not in conversation_histories:
-            # Use different temperature for owner vs others
-            temperature = 0.5 if is_owner else 0.8
-            conversation_histories[conversation_key] = {
-                'messages': [{"role": "system", "content": CHATBOT_SYSTEM_PROMPT}],
-                'last_activity': time.time(),
-                'temperature': temperature
-            }
-        
-        # Add user message to history
-        conversation_histories[conversation_key]['messages'].append({
-            "role": "user", 
-            "content": user_message
-        })
-        conversation_histories[conversation_key]['last_activity'] = time.time()
-        
-        # Keep only the last 10 messages to manage context length
-        if len(conversation_histories[conversation_key]['messages']) > 11:  # 1 system + 10 exchanges
-            # Keep system message and last 10 exchanges
-            conversation_histories[conversation_key]['messages'] = (
-                [conversation_histories[conversation_key]['messages'][0]] + 
-                conversation_histories[conversation_key]['messages'][-10:]
+        async with chat_slot(guild_id):
+            # Get or create conversation history (different temperature for owner vs others)
+            conversation = conversations.get(user_id, guild_id, 0.5 if is_owner else 0.8)
+            conversations.append(conversation, "user", user_message)
+
+            # Call Groq API with appropriate temperature (on a copy: other requests may append meanwhile)
+            start = time.perf_counter()
+            chat_completion = await groq_client.chat.completions.create(
+                messages=list(conversation['messages']),
+                model="llama-3.1-8b-instant",
+                temperature=conversation['temperature'],
+                max_tokens=500,
+                top_p=1,
+                stream=on_delta is not None,
             )
-        
-        # Call Groq API with appropriate temperature
-        temperature = conversation_histories[conversation_key]['temperature']
-        chat_completion = groq_client.chat.completions.create(
-            messages=conversation_histories[conversation_key]['messages'],
-            model="llama-3.1-8b-instant",
-            temperature=temperature,
-            max_tokens=500,
-            top_p=1,
-            stream=False,
-        )
-        
-        # Get the response
-        response = chat_completion.choices[0].message.content
-        
-        # Add assistant response to history
-        conversation_histories[conversation_key]['messages'].append({
-            "role": "assistant", 
-            "content": response
-        })
-        
-        # Clean up old conversations periodically
-        if random.random() < 0.1:  # 10% chance on each request
-            cleanup_old_conversations()
-            
-        return response
-        
+
+            # Get the response and add it to history
+            if on_delta is None:
+                response = chat_completion.choices[0].message.content
+                usage = chat_completion.usage
+            else:
+                parts = []
+                usage = None
+                async for chunk in chat_completion:
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        if not parts:
+                            metrics.observe("area69_chat_first_token_seconds", time.perf_counter() - start)
+                        parts.append(delta)
+                        await on_delta(delta)
+                    # Groq reports usage on the final chunk under x_groq
+                    usage = getattr(getattr(chunk, "x_groq", None), "usage", None) or usage
+                response = "".join(parts)
+            metrics.observe("area69_chat_seconds", time.perf_counter() - start,
+                            mode="complete" if on_delta is None else "stream")
+            if usage is not None:
+                metrics.inc("area69_chat_tokens_total", usage.prompt_tokens or 0, kind="prompt")
+                metrics.inc("area69_chat_tokens_total", usage.completion_tokens or 0, kind="completion")
+            conversations.append(conversation, "assistant", response)
+            return response
+
+    except ChatBusy:
+        metrics.inc("area69_chat_errors_total", reason="busy")
+        return CHAT_BUSY_REPLY
     except Exception as e:
+        metrics.inc("area69_chat_errors_total", reason="api")
         print(f"Error generating chatbot response: {e}")
         return "Sorry, I'm having trouble thinking right now. Try again in a moment!"
 
-@bot.event
-async def on_message(message):
-    # Existing on_message code (keep all your current on_message functionality)
-    if message.author.bot:
-        return
-
-    # Show AFK reason when mentioning someone AFK
-    for mention in message.mentions:
-        uid = str(mention.id)
-        if uid in afk_users:
-            afk_data = afk_users[uid]
-            await send_temp_message(
-                message.channel,
-                create_embed("⏸️ AFK", f"{mention.display_name} is AFK: {afk_data['reason']}", discord.Color.gold())
-            )
-
-    # Remove AFK when AFK user speaks
-    uid_author = str(message.author.id)
-    if uid_author in afk_users:
-        afk_data = afk_users.pop(uid_author)
-        try:
-            await message.author.edit(nick=afk_data['original_nick'])
-        except:
-            pass
-        await send_temp_message(
-            message.channel,
-            create_embed("⏯️ Welcome Back", f"{message.author.mention}, I've removed your AFK status.", discord.Color.green())
-        )
-        save_data()
-
-    # Handle edit ratings
-    if EDIT_CHANNEL_ID and message.channel.id == EDIT_CHANNEL_ID:
-        # ✅ Check for actual video files (not GIFs)
-        has_video_attachment = any(
-            attachment.content_type and attachment.content_type.startswith("video/")
-            for attachment in message.attachments
-        )
-
-        # ✅ Also check for streamable.com links
-        is_streamable = any("streamable.com" in word for word in message.content.split())
-
-        if has_video_attachment or is_streamable:
-            embed = make_rating_embed(message.author, message.id)
-            view = RatingView(message.author, message.id)
-            await message.reply(embed=embed, view=view)
-    
-    # NEW: Handle chatbot mentions
-    if bot.user.mentioned_in(message) and not message.mention_everyone:
-        # Get the message content without the mention
-        content = message.clean_content.replace(f"@{bot.user.name}", "").strip()
-        
-        # Don't respond to empty messages or commands
-        if content and not content.startswith(tuple(bot.command_prefix)):
-            # Check if user is owner
-            is_owner = str(message.author.id) == SERVER_OWNER_ID
-            
-            # Replace mentions with proper format
-            content = replace_mentions_with_ids(content, message)
-            
-            # Show typing indicator while processing
-            async with message.channel.typing():
-                response = await generate_chat_response(content, message.author.id, message.guild.id, is_owner)
-                
-                # Ensure mentions in the response work properly
-                for user in message.mentions:
-                    response = response.replace(f"@{user.name}", f"<@{user.id}>")
-                    response = response.replace(f"@{user.display_name}", f"<@{user.id}>")
-                
-                # Split long responses to avoid Discord's character limit
-                if len(response) > 2000:
-                    chunks = [response[i:i+2000] for i in range(0, len(response), 2000)]
-                    for chunk in chunks:
-                        await message.reply(chunk)
-                else:
-                    await message.reply(response)
-            
-            # Don't process commands if we handled it as a chatbot message
-            return
-
+def split_message(text: str, limit: int = DISCORD_MESSAGE_LIMIT) -> list:
+    """Split text into message-sized chunks, breaking on a newline or space where possible.
+
+    Chunk boundaries only depend on the text before them, so splitting a growing
+    stream keeps already-sent chunks stable.
+    """
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit + 1)
+        if cut <= 0:
+            cut = text.rfind(" ", 0, limit + 1)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip("\n ")
+    chunks.append(text)
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+class StreamingReply:
+    """Reply that grows as deltas arrive: edited at most every CHAT_STREAM_EDIT_INTERVAL,
+    rolling over to a new reply at Discord's message limit."""
+
+    def __init__(self, message: discord.Message):
+        self.message = message
+        self.text = ""
+        self.sent = []  # [[discord.Message, content]]
+        self._last_render = 0.0
+
+    async def feed(self, delta: str):
+        self.text += delta
+        if time.monotonic() - self._last_render >= CHAT_STREAM_EDIT_INTERVAL:
+            await self.render()
+
+    async def finish(self, response: str):
+        if not self.text:  # nothing streamed (busy, error or chatbot disabled)
+            self.text = response
+        await self.render()
+
+    async def render(self):
+        self._last_render = time.monotonic()
+        # Ensure mentions in the response work properly
+        chunks = split_message(replace_mentions_with_ids(self.text, self.message))
+        for i, chunk in enumerate(chunks):
+            if i < len(self.sent):
+                if self.sent[i][1] != chunk:
+                    await self.sent[i][0].edit(content=chunk)
+                    self.sent[i][1] = chunk
+            else:
+                self.sent.append([await self.message.reply(chunk), chunk])
+
+@pipeline.stage(lambda message: message.mentions and not message.mention_everyone and bot.user.mentioned_in(message),
+                exclusive=True)
+async def chatbot(message):
+    """Reply to messages that mention the bot; returns True when handled."""
+    # Get the message content without the mention
+    content = message.clean_content.replace(f"@{bot.user.name}", "").strip()
+
+    # Don't respond to empty messages or commands
+    if not content or content.startswith(tuple(bot.command_prefix)):
+        return False
+
+    if not rate_limit_exempt(message.author):
+        retry_after = rate_limiter.consume(RATE_LIMIT_COSTS["chat"], message.author.id,
+                                           message.channel.id, message.guild.id)
+        if retry_after:
+            await send_slow_down(message.channel, message.author.id, retry_after)
+            return True
+
+    # Check if user is owner
+    is_owner = str(message.author.id) == SERVER_OWNER_ID
+
+    # Replace mentions with proper format
+    content = replace_mentions_with_ids(content, message)
+
+    # Show typing indicator while processing
+    async with message.channel.typing():
+        reply = StreamingReply(message)
+        response = await generate_chat_response(content, message.author.id, message.guild.id, is_owner,
+                                                on_delta=reply.feed if CHAT_STREAMING else None)
+        # Final render; long responses are split to avoid Discord's character limit
+        await reply.finish(response)
+
+    # Don't process commands if we handled it as a chatbot message
+    return True
+
+@pipeline.stage(lambda message: message.content.startswith(bot.command_prefix), exclusive=True)
+async def prefix_commands(message):
     await bot.process_commands(message)
 
-# ========= Keep Alive (Replit) =========
-def run_flask():
-    app = Flask(__name__)
-
-    @app.route('/')
-    def home():
-        return "Area 69 Bot is alive!"
-
-    app.run(host='0.0.0.0', port=8080)
-
-def ping_replit():
-    while True:
-        try:
-            requests.get(f"https://{os.getenv('REPL_SLUG')}.{os.getenv('REPL_OWNER')}.repl.co")
-            time.sleep(300)
-        except:
-            time.sleep(60)
-
-def start_keepalive():
-    Thread(target=run_flask, daemon=True).start()
-    Thread(target=ping_replit, daemon=True).start()
+# ========= Health / keep-alive =========
+# Served from the bot's own event loop. In a cluster, worker N listens on HEALTH_PORT + N.
+HEALTH_HOST = os.getenv("HEALTH_HOST", "0.0.0.0")
+HEALTH_PORT = int(os.getenv("HEALTH_PORT", 8080))  # 0 disables the server
+HEALTH_MAX_HEARTBEAT_AGE = 90  # seconds without a heartbeat ACK before /health reports unhealthy
+LOOP_LAG_INTERVAL = 0.5        # seconds between event loop lag samples
+_replit_url = (f"https://{os.getenv('REPL_SLUG')}.{os.getenv('REPL_OWNER')}.repl.co"
+               if os.getenv('REPL_SLUG') and os.getenv('REPL_OWNER') else "")
+KEEPALIVE_PING_URL = os.getenv("KEEPALIVE_PING_URL", _replit_url)  # set it empty to disable the self-ping
+KEEPALIVE_PING_INTERVAL = 300  # seconds
+
+class LoopLagMonitor:
+    """Samples how late a short sleep wakes up, i.e. how long callbacks block the loop."""
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL, window: int = 120):
+        self.interval = interval
+        self.samples = collections.deque(maxlen=window)  # lag in seconds, newest last
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - start - self.interval)
+            self.samples.append(lag)
+            metrics.observe("area69_loop_lag_seconds", lag)
+
+    @property
+    def lag(self) -> float:
+        return self.samples[-1] if self.samples else 0.0
+
+    @property
+    def max_lag(self) -> float:
+        return max(self.samples, default=0.0)
+
+loop_monitor = LoopLagMonitor()
+
+def gateway_status() -> dict:
+    """{shard_id: (latency seconds, seconds since the last heartbeat ACK or None)}."""
+    if SHARDED:
+        sockets = {shard_id: getattr(info, "_parent", None) for shard_id, info in bot.shards.items()}
+        sockets = {shard_id: getattr(parent, "ws", None) for shard_id, parent in sockets.items()}
+    else:
+        sockets = {0: bot.ws}
+    status = {}
+    for shard_id, ws in sockets.items():
+        # discord.py keeps the last ACK (perf_counter) on the socket's private keep-alive thread
+        last_ack = getattr(getattr(ws, "_keep_alive", None), "_last_ack", None)
+        status[shard_id] = (ws.latency if ws else float("inf"),
+                            time.perf_counter() - last_ack if last_ack else None)
+    return status
+
+class HealthServer:
+    """aiohttp web app: `/` for uptime pingers, `/health` for real liveness."""
+
+    def __init__(self):
+        self.app = web.Application()
+        self.app.router.add_get("/", self.home)
+        self.app.router.add_get("/health", self.health)
+        self.app.router.add_get("/metrics", self.metrics)
+        self._runner = None
+        self._ping_task = None
+        self.started = time.time()
+
+    async def start(self):
+        loop_monitor.start()
+        if KEEPALIVE_PING_URL and CLUSTER_WORKER in (None, 0):
+            self._ping_task = asyncio.create_task(self._self_ping())
+        if not HEALTH_PORT or self._runner is not None:
+            return
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        port = HEALTH_PORT + (CLUSTER_WORKER or 0)
+        await web.TCPSite(self._runner, HEALTH_HOST, port).start()
+        print(f"Health server listening on {HEALTH_HOST}:{port}")
+
+    async def stop(self):
+        loop_monitor.stop()
+        if self._ping_task is not None:
+            self._ping_task.cancel()
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def home(self, request):
+        return web.Response(text="Area 69 Bot is alive!")
+
+    async def health(self, request):
+        shards = {}
+        healthy = bot.is_ready()
+        for shard_id, (latency, heartbeat_age) in gateway_status().items():
+            shard_ok = heartbeat_age is not None and heartbeat_age < HEALTH_MAX_HEARTBEAT_AGE
+            healthy = healthy and shard_ok
+            shards[shard_id] = {
+                "ok": shard_ok,
+                "latency_ms": round(latency * 1000, 1) if latency != float("inf") else None,
+                "last_heartbeat_s": round(heartbeat_age, 1) if heartbeat_age is not None else None,
+            }
+        body = {
+            "status": "ok" if healthy else "unhealthy",
+            "ready": bot.is_ready(),
+            "uptime_s": round(time.time() - self.started),
+            "guilds": len(bot.guilds),
+            "loop_lag_ms": round(loop_monitor.lag * 1000, 2),
+            "loop_lag_max_ms": round(loop_monitor.max_lag * 1000, 2),
+            "shards": shards,
+        }
+        return web.json_response(body, status=200 if healthy else 503)
+
+    async def metrics(self, request):
+        if not metrics.enabled:
+            raise web.HTTPNotFound(text="metrics are disabled (set METRICS=1)")
+        return web.Response(text=metrics.render(),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def _self_ping(self):
+        """Hit KEEPALIVE_PING_URL periodically (keeps free hosts like Replit from idling)."""
+        while True:
+            try:
+                await http_client.start()
+                async with http_client.session.get(KEEPALIVE_PING_URL) as response:
+                    await response.read()
+                await asyncio.sleep(KEEPALIVE_PING_INTERVAL)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                await asyncio.sleep(60)
+
+health_server = HealthServer()
+
+# ========= Cluster launcher =========
+CLUSTER_RESTART_DELAY = 5  # seconds before restarting a crashed worker (doubles per crash, max 5 min)
+
+def shard_ranges(shard_count: int, workers: int) -> list:
+    """Split shards 0..shard_count-1 into `workers` contiguous ranges."""
+    per_worker, extra = divmod(shard_count, workers)
+    ranges, start = [], 0
+    for i in range(workers):
+        end = start + per_worker + (i < extra)
+        ranges.append(range(start, end))
+        start = end
+    return ranges
+
+def run_cluster(workers: int):
+    """Run the bot as `workers` child processes of this script, restarting any that exit.
+
+    Shards (SHARD_COUNT, default one per worker) are split evenly; all workers share the
+    SQLite database. Ctrl+C / SIGTERM stops the whole cluster.
+    """
+    shard_count = SHARD_COUNT or workers
+    if shard_count < workers:
+        raise SystemExit("SHARD_COUNT must be at least CLUSTER_WORKERS")
+    if STORAGE_BACKEND != "sqlite":
+        print("Cluster mode shares state through SQLite; using STORAGE_BACKEND=sqlite")
+    shared = SqliteStorage(SQLITE_FILE)
+    shared.load()  # import/migrate once, before the workers open the file
+    shared.close()
+
+    def spawn(index, shards):
+        env = dict(os.environ, CLUSTER_WORKER=str(index), STORAGE_BACKEND="sqlite",
+                   SHARD_COUNT=str(shard_count), SHARD_IDS=f"{shards.start}-{shards.stop - 1}")
+        print(f"Starting worker {index} (shards {shards.start}-{shards.stop - 1} of {shard_count})")
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+
+    ranges = shard_ranges(shard_count, workers)
+    procs = [spawn(i, shards) for i, shards in enumerate(ranges)]
+    started = [time.monotonic()] * workers
+    restart_at = [None] * workers
+    crashes = [0] * workers
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        while True:
+            time.sleep(1)
+            now = time.monotonic()
+            for i, proc in enumerate(procs):
+                if proc.poll() is None:
+                    continue
+                if restart_at[i] is None:
+                    if now - started[i] > 300:
+                        crashes[i] = 0  # it ran fine for a while, so don't keep backing off
+                    delay = min(CLUSTER_RESTART_DELAY * 2 ** crashes[i], 300)
+                    crashes[i] += 1
+                    restart_at[i] = now + delay
+                    print(f"Worker {i} exited with code {proc.returncode}; restarting in {delay}s")
+                elif now >= restart_at[i]:
+                    restart_at[i] = None
+                    procs[i] = spawn(i, ranges[i])
+                    started[i] = now
+    finally:
+        for proc in procs:
+            if proc.poll() is None:
+                proc.terminate()
+        for proc in procs:
+            try:
+                proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
 
 # ========= Start =========
-load_data()
-start_keepalive()
-bot.run(os.getenv('TOKEN'))
+if __name__ == "__main__":
+    if CLUSTER_WORKERS > 1 and CLUSTER_WORKER is None:
+        run_cluster(CLUSTER_WORKERS)
+        raise SystemExit
+    load_data()
+    bot.run(os.getenv('TOKEN'))
+    storage.close()  # flush anything still pending after the bot shuts down